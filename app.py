@@ -86,6 +86,7 @@ def get_db():
     db = getattr(g, '_database', None)
     if db is None:
         db = g._database = sqlite3.connect(DATABASE)
+        db.execute(f"PRAGMA cache_size=-{config.DB_CACHE_SIZE_KIB}")
         db.row_factory = sqlite3.Row
     return db
 
@@ -601,7 +602,8 @@ def get_navigation_image(current_id, filters, direction):
 
         # 获取符合条件的所有ID
         all_ids_query = f"SELECT id {base_query}"
-        all_ids = [row[0] for row in db.execute(all_ids_query, params).fetchall()]
+        all_ids = utils.rotate_for_seed([row[0] for row in db.execute(all_ids_query, params).fetchall()],
+                                        filters, filters.get('sort', 'random'))
         
         if not all_ids:
             return jsonify({'success': False, 'error': 'No images found'})
@@ -741,4 +743,7 @@ if __name__ == '__main__':
     # 初始化日志系统
     logger.init_app_logging(app)
     logger.logger.app_logger.info("Gallery application starting...")
+    # 随机排序依赖的索引（公开页面使用只读连接，在启动时统一创建）
+    with sqlite3.connect(DATABASE) as conn:
+        utils.ensure_shuffle_index(conn)
     app.run(host='0.0.0.0', port=5000, debug=True)
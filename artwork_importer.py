@@ -4,6 +4,7 @@
 """
 
 import os
+import re
 import sqlite3
 import shutil
 from datetime import datetime
@@ -12,6 +13,20 @@ import imagehash
 import config
 import utils
 
+# LLM分类输出中的 "Category: xxx" / "Classification: xxx" 行
+LLM_FIELD_RE = re.compile(r'^\s*(Category|Classification):(.*)$', re.MULTILINE)
+
+
+def parse_llm_classification(content):
+    """从LLM分类输出中一次提取 (category, classification)，均为小写，缺失时为None
+
+    同一字段出现多次时以最后一行为准；值的去空白方式与逐行 strip() 解析相同。
+    """
+    fields = {}
+    for name, value in LLM_FIELD_RE.findall(content):
+        fields[name] = value.replace(f'{name}:', '').strip().lower()
+    return fields.get('Category'), fields.get('Classification')
+
 
 def add_artwork_to_database(
     file_path,
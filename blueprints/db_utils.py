@@ -25,6 +25,7 @@ def get_db_readonly():
     if db is None:
         db = g._database_readonly = sqlite3.connect(config.DB_FILE)
         db.execute("PRAGMA query_only = ON")
+        db.execute(f"PRAGMA cache_size=-{config.DB_CACHE_SIZE_KIB}")
         db.row_factory = sqlite3.Row
     return db
 
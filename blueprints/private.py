@@ -52,6 +52,7 @@ def get_db():
     db = getattr(g, '_database', None)
     if db is None:
         db = g._database = sqlite3.connect(DATABASE)
+        db.execute(f"PRAGMA cache_size=-{config.DB_CACHE_SIZE_KIB}")
         db.row_factory = sqlite3.Row
     return db
 
@@ -126,11 +127,8 @@ def gallery():
     total_artworks = count_row[0] if count_row else 0
     total_pages = math.ceil(total_artworks / IMAGES_PER_PAGE) if total_artworks > 0 else 1
 
-    main_query = "SELECT * " + base_query
-    if IMAGES_PER_PAGE:
-        main_query += f" LIMIT {IMAGES_PER_PAGE} OFFSET {offset}"
-
-    artworks = db.execute(main_query, params).fetchall()
+    artworks = utils.fetch_artwork_page(db, base_query, params, filters, sort_key,
+                                        total_artworks, offset, IMAGES_PER_PAGE)
 
     # Get aspect ratios for waterfall layout
     aspect_ratios = {}
@@ -210,7 +208,8 @@ def slide_view():
     base_query, params = utils.build_artwork_query(filters, filters.get('sort', 'random'))
 
     all_ids_query = f"SELECT id {base_query}"
-    all_ids = [row[0] for row in db.execute(all_ids_query, params).fetchall()]
+    all_ids = utils.rotate_for_seed([row[0] for row in db.execute(all_ids_query, params).fetchall()],
+                                    filters, filters.get('sort', 'random'))
 
     total_images = len(all_ids)
 
@@ -226,18 +225,15 @@ def slide_view():
                 if artwork:
                     current_position = all_ids.index(current_id) + 1
                 else:
-                    artwork_query = f"SELECT * {base_query} LIMIT 1"
-                    artwork = db.execute(artwork_query, params).fetchone()
+                    artwork = db.execute("SELECT * FROM artworks WHERE id = ?", (all_ids[0],)).fetchone()
                     if artwork:
                         current_position = 1
             except ValueError:
-                artwork_query = f"SELECT * {base_query} LIMIT 1"
-                artwork = db.execute(artwork_query, params).fetchone()
+                artwork = db.execute("SELECT * FROM artworks WHERE id = ?", (all_ids[0],)).fetchone()
                 if artwork:
                     current_position = 1
         else:
-            artwork_query = f"SELECT * {base_query} LIMIT 1"
-            artwork = db.execute(artwork_query, params).fetchone()
+            artwork = db.execute("SELECT * FROM artworks WHERE id = ?", (all_ids[0],)).fetchone()
             if artwork:
                 current_position = 1
 
@@ -291,7 +287,7 @@ def image_wall():
         return redirect(url_for('private.image_wall', **filters))
     
     main_query = "SELECT * " + base_query
-    artworks = db.execute(main_query, params).fetchall()
+    artworks = utils.rotate_for_seed(db.execute(main_query, params).fetchall(), filters, sort_key)
     
     # Get aspect ratios for waterfall layout
     aspect_ratios = {}
@@ -561,7 +557,8 @@ def get_navigation_image(current_id, filters, direction):
         base_query, params = utils.build_artwork_query(filters, filters.get('sort', 'random'))
 
         all_ids_query = f"SELECT id {base_query}"
-        all_ids = [row[0] for row in db.execute(all_ids_query, params).fetchall()]
+        all_ids = utils.rotate_for_seed([row[0] for row in db.execute(all_ids_query, params).fetchall()],
+                                        filters, filters.get('sort', 'random'))
         
         if not all_ids:
             return jsonify({'success': False, 'error': 'No images found'})
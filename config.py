@@ -1,5 +1,6 @@
 # 1. 数据库文件名
 DB_FILE = "zootopia_gallery.db"
+DB_CACHE_SIZE_KIB = 32000  # 网页端每个数据库连接的页缓存大小
 
 # 2. 支持的图片文件扩展名
 SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', 'bmp')
@@ -15,6 +16,7 @@ THUMBNAIL_SIZE = (600, 2000)
 THUMBNAIL_QUALITY = 85
 MAX_SIMILAR_RESULTS = 50
 DEFAULT_SEARCH_THRESHOLD = 10
+REVIEW_RESAMPLE_FILTER = 'LANCZOS'  # LLM审核图片的缩放滤镜（LANCZOS/BICUBIC/HAMMING/BILINEAR，越靠后越快）
 
 # 6. 页面显示配置
 IMAGES_PER_PAGE = 24
@@ -10,6 +10,7 @@ import re
 import sqlite3
 import datetime
 import config
+import utils
 from PIL import Image
 import traceback # 新增: 导入 traceback 模块
 import imagehash
@@ -111,6 +112,7 @@ def setup_database():
             CHECK(category IN ('fanart_comic', 'fanart_non_comic', 'real_photo', 'other'))
     )
     ''')
+    utils.ensure_shuffle_index(conn)
     print(f"数据库 '{config.DB_FILE}' 已准备就绪。")
     conn.commit()
     conn.close()
@@ -213,13 +213,7 @@ def classify_with_lmstudio(image_path, enable_streaming=True, max_retries=LLM_MA
             else:
                 content = response.json()['choices'][0]['message']['content']
 
-            category = classification = None
-            for line in content.split('\n'):
-                line = line.strip()
-                if line.startswith('Category:'):
-                    category = line.replace('Category:', '').strip().lower()
-                elif line.startswith('Classification:'):
-                    classification = line.replace('Classification:', '').strip().lower()
+            category, classification = artwork_importer.parse_llm_classification(content)
 
             if category not in VALID_CATEGORIES:
                 raise ValueError(f"LLM返回了无法识别的category: '{category}'")
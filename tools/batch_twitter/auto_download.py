@@ -5,16 +5,52 @@
 支持指定下载之后n天的内容
 """
 
+import asyncio
 import os
 import re
-import subprocess
 import sys
 from datetime import datetime, timedelta
+from operator import itemgetter
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DOWNLOADS_DIR = os.path.join(SCRIPT_DIR, 'downloads')
+DOWNLOAD_SCRIPT = os.path.join(SCRIPT_DIR, 'download.py')
+
+# 同时运行的下载进程数（可通过 --jobs 覆盖）
+MAX_CONCURRENT_DOWNLOADS = 4
+
+# 传给download.py的请求延迟（秒）。并发时按进程数放大，使所有批次合计的请求速率保持不变
+DOWNLOAD_SLEEP = 0.1
+
+# 任一批次输出中出现限速(429)后，暂停启动新批次的时间（秒）
+RATE_LIMIT_COOLDOWN = 60
+RATE_LIMIT_RE = re.compile(r'\b429\b|rate limit', re.IGNORECASE)
+
+# 单个批次的最长运行时间（秒），超时后终止该批次
+BATCH_TIMEOUT = 3600
+# 终止后等待进程退出的时间（秒），仍未退出则强制结束
+TERMINATE_GRACE_PERIOD = 10
+
+# 搜索URL模板，每个批次只需填入日期
+SEARCH_URL_TEMPLATE = (
+    "https://x.com/search?q=(%23zootopia2%20OR%20%23zootopia%20OR%20"
+    "%23wildehopps%20OR%20%23zootopiafanart)%20"
+    "until%3A{end}%20since%3A{start}&src=typed_query&f=live"
+)
+
+# 日期文件夹名称格式: YYMMDD-YYMMDD
+DATE_FOLDER_RE = re.compile(r'(\d{2})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2})$')
+
+# 限速冷却截止时间（事件循环时间），所有批次共享
+_rate_limited_until = 0.0
 
 
 def parse_date_folder(folder_name):
     """解析日期文件夹名称，返回结束日期。格式: YYMMDD-YYMMDD"""
-    match = re.match(r'(\d{2})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2})$', folder_name)
+    # 先用长度和分隔符过滤掉绝大多数无关目录，再做正则匹配
+    if len(folder_name) != 13 or folder_name[6] != '-':
+        return None
+    match = DATE_FOLDER_RE.match(folder_name)
     if match:
         yy1, mm1, dd1, yy2, mm2, dd2 = match.groups()
         try:
@@ -27,23 +63,18 @@ def parse_date_folder(folder_name):
 
 def get_latest_date_folder():
     """获取最新的日期文件夹"""
-    script_dir = os.path.dirname(__file__)
-    downloads_dir = os.path.join(script_dir, 'downloads')
-
-    if not os.path.exists(downloads_dir):
+    if not os.path.exists(DOWNLOADS_DIR):
         return None
 
     date_folders = []
-    for dirname in os.listdir(downloads_dir):
-        end_date = parse_date_folder(dirname)
-        if end_date:
-            date_folders.append((dirname, end_date))
-
-    if not date_folders:
-        return None
+    with os.scandir(DOWNLOADS_DIR) as it:
+        for entry in it:
+            end_date = parse_date_folder(entry.name)
+            if end_date and entry.is_dir(follow_symlinks=False):
+                date_folders.append((entry.name, end_date))
 
-    date_folders.sort(key=lambda x: x[1])
-    return date_folders[-1]
+    # 只需要结束日期最晚的一个，不必整体排序
+    return max(date_folders, key=itemgetter(1), default=None)
 
 
 def generate_next_date_range(last_end_date):
@@ -60,27 +91,145 @@ def generate_next_date_range(last_end_date):
     return folder_name, url_start, url_end
 
 
-def check_folder_exists(folder_name):
-    """检查文件夹是否已存在"""
-    script_dir = os.path.dirname(__file__)
-    downloads_dir = os.path.join(script_dir, 'downloads')
-    folder_path = os.path.join(downloads_dir, folder_name)
-    return os.path.exists(folder_path)
+def list_existing_folders():
+    """一次扫描下载目录，返回已存在的文件夹名称集合"""
+    try:
+        with os.scandir(DOWNLOADS_DIR) as it:
+            return {entry.name for entry in it if entry.is_dir()}
+    except FileNotFoundError:
+        return set()
+
+
+async def forward_output(process, prefix):
+    """逐行转发子进程输出（加上批次前缀，并发时便于区分），直到进程结束；检测到限速时开始冷却"""
+    global _rate_limited_until
+    loop = asyncio.get_running_loop()
+    async for line in process.stdout:
+        text = line.decode('utf-8', errors='replace').rstrip()
+        print(f"[{prefix}] {text}", flush=True)
+        if RATE_LIMIT_RE.search(text):
+            _rate_limited_until = loop.time() + RATE_LIMIT_COOLDOWN
+    await process.wait()
+
+
+async def wait_for_rate_limit_cooldown():
+    """最近有批次被限速时，等到冷却结束再启动新批次"""
+    loop = asyncio.get_running_loop()
+    while (remaining := _rate_limited_until - loop.time()) > 0:
+        print(f"检测到限速，{remaining:.0f} 秒后再启动新批次...")
+        await asyncio.sleep(remaining)
+
+
+async def terminate_process(process):
+    """先请求子进程退出，超过宽限时间仍未退出则强制结束"""
+    process.terminate()
+    try:
+        await asyncio.wait_for(process.wait(), TERMINATE_GRACE_PERIOD)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def run_download_batch(index, total, plan, semaphore, sleep_time):
+    """在并发限制下运行一个批次的下载，返回是否成功"""
+    async with semaphore:
+        await wait_for_rate_limit_cooldown()
+        print(f"\n▶ 批次 {index}/{total} 开始: {plan['folder']} ({plan['url_start']} 到 {plan['url_end']})")
+
+        # 构建URL
+        url = SEARCH_URL_TEMPLATE.format(start=plan['url_start'], end=plan['url_end'])
+
+        # 执行下载命令
+        command = [
+            sys.executable,  # 使用当前Python解释器
+            '-u',  # 子进程不缓冲输出，便于实时转发
+            DOWNLOAD_SCRIPT,
+            url,
+            '--resume', plan['folder'],
+            '--sleep', str(sleep_time),
+            '--global-archive',  # 同一推文可能匹配多天的搜索，共用下载记录避免重复下载
+        ]
+
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+
+        try:
+            await asyncio.wait_for(forward_output(process, plan['folder']), BATCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"\n✗ 批次 {index} 超过 {BATCH_TIMEOUT} 秒未完成，正在终止: {plan['folder']}")
+            await terminate_process(process)
+            return False
+
+        if process.returncode == 0:
+            print(f"\n✓ 批次 {index} 下载完成: {plan['folder']}")
+            return True
+
+        print(f"\n✗ 批次 {index} 下载失败: {plan['folder']}")
+        return False
+
+
+async def run_downloads(download_plan, concurrency):
+    """并发执行所有批次，返回失败的批次列表"""
+    semaphore = asyncio.Semaphore(concurrency)
+    total = len(download_plan)
+    sleep_time = DOWNLOAD_SLEEP * min(concurrency, total)
+    results = await asyncio.gather(*(
+        run_download_batch(index, total, plan, semaphore, sleep_time)
+        for index, plan in enumerate(download_plan, 1)
+    ))
+    return [plan for plan, success in zip(download_plan, results) if not success]
+
+
+def run_downloads_in_process(download_plan):
+    """在当前进程内依次下载（--jobs 1），各批次复用已加载的配置和gallery-dl的连接，返回失败的批次列表"""
+    sys.path.insert(0, SCRIPT_DIR)
+    from download import download
+
+    failed = []
+    total = len(download_plan)
+    for index, plan in enumerate(download_plan, 1):
+        print(f"\n▶ 批次 {index}/{total} 开始: {plan['folder']} ({plan['url_start']} 到 {plan['url_end']})")
+        url = SEARCH_URL_TEMPLATE.format(start=plan['url_start'], end=plan['url_end'])
+        try:
+            download(url, resume_dir=plan['folder'], sleep_time=DOWNLOAD_SLEEP, global_archive=True)
+        except SystemExit as e:
+            if e.code == 130:
+                raise KeyboardInterrupt
+            if e.code:
+                print(f"\n✗ 批次 {index} 下载失败: {plan['folder']}")
+                failed.append(plan)
+                continue
+        print(f"\n✓ 批次 {index} 下载完成: {plan['folder']}")
+    return failed
 
 
 def main():
     # 解析命令行参数
     days_to_download = 1  # 默认下载1天
-    if len(sys.argv) > 1:
-        try:
-            days_to_download = int(sys.argv[1])
+    concurrency = MAX_CONCURRENT_DOWNLOADS
+    args = sys.argv[1:]
+    try:
+        if '--jobs' in args:
+            index = args.index('--jobs')
+            concurrency = int(args[index + 1])
+            del args[index:index + 2]
+            if concurrency < 1:
+                print("错误: 并发数必须大于0")
+                sys.exit(1)
+        if args:
+            days_to_download = int(args[0])
             if days_to_download < 1:
                 print("错误: 天数必须大于0")
                 sys.exit(1)
-        except ValueError:
-            print("用法: python auto_download.py [天数]")
-            print("示例: python auto_download.py 7  # 下载之后7天的内容")
-            sys.exit(1)
+    except (ValueError, IndexError):
+        print("用法: python auto_download.py [天数] [--jobs 并发数]")
+        print("示例: python auto_download.py 7  # 下载之后7天的内容")
+        print(f"      python auto_download.py 7 --jobs 2  # 最多同时下载2个批次（默认 {MAX_CONCURRENT_DOWNLOADS}）")
+        print("      python auto_download.py 7 --jobs 1  # 在当前进程内依次下载")
+        sys.exit(1)
     
     print("=" * 70)
     print("自动化Twitter下载脚本")
@@ -105,11 +254,12 @@ def main():
     
     download_plan = []
     current_date = last_end_date
+    existing_folders = list_existing_folders()
     
     for day_num in range(days_to_download):
         next_folder, url_start, url_end = generate_next_date_range(current_date)
         
-        if check_folder_exists(next_folder) and day_num > 0:
+        if next_folder in existing_folders and day_num > 0:
             print(f"\n警告: 文件夹 {next_folder} 已存在")
             print(f"将只下载前 {day_num} 个批次")
             break
@@ -135,48 +285,27 @@ def main():
     
     # 执行下载
     print("\n" + "=" * 70)
-    print("开始批量下载...")
+    print(f"开始批量下载（最多同时 {concurrency} 个批次）...")
     print("=" * 70)
-    
-    for day_num, plan in enumerate(download_plan):
-        print(f"\n{'=' * 70}")
-        print(f"批次 {day_num + 1}/{len(download_plan)}: {plan['folder']}")
-        print(f"日期范围: {plan['url_start']} 到 {plan['url_end']}")
-        print("=" * 70)
-        
-        # 构建URL
-        url = (
-            f"https://x.com/search?q=(%23zootopia2%20OR%20%23zootopia%20OR%20"
-            f"%23wildehopps%20OR%20%23zootopiafanart)%20"
-            f"until%3A{plan['url_end']}%20since%3A{plan['url_start']}&src=typed_query&f=live"
-        )
-        
-        # 执行下载命令
-        script_dir = os.path.dirname(__file__)
-        download_script = os.path.join(script_dir, 'download.py')
-        
-        command = [
-            sys.executable,  # 使用当前Python解释器
-            download_script,
-            url,
-            '--resume', plan['folder'],
-            '--sleep', '0.1'
-        ]
-        
-        try:
-            subprocess.run(command, check=True)
-            print(f"\n✓ 批次 {day_num + 1} 下载完成: {plan['folder']}")
-            
-        except subprocess.CalledProcessError:
-            print(f"\n✗ 批次 {day_num + 1} 下载失败")
-            print(f"已完成 {day_num}/{len(download_plan)} 个批次")
-            sys.exit(1)
-        except KeyboardInterrupt:
-            print(f"\n\n下载已中断")
-            print(f"已完成 {day_num}/{len(download_plan)} 个批次")
-            sys.exit(1)
-    
+
+    try:
+        if concurrency == 1:
+            # 顺序下载时不必为每个批次启动新的Python进程
+            failed = run_downloads_in_process(download_plan)
+        else:
+            failed = asyncio.run(run_downloads(download_plan, concurrency))
+    except KeyboardInterrupt:
+        print(f"\n\n下载已中断")
+        sys.exit(1)
+
     print("\n" + "=" * 70)
+    if failed:
+        print(f"已完成 {len(download_plan) - len(failed)}/{len(download_plan)} 个批次，以下批次下载失败:")
+        for plan in failed:
+            print(f"  ✗ {plan['folder']}  ({plan['url_start']} 到 {plan['url_end']})")
+        print("=" * 70)
+        sys.exit(1)
+
     print(f"✓ 全部完成! 共下载 {len(download_plan)} 个批次")
     print("=" * 70)
 
@@ -4,64 +4,127 @@ Twitter批量下载工具
 用法: python download.py <twitter_url> [--resume <directory_name>]
 """
 
+import logging
 import subprocess
 import sys
 import os
 import re
 from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
 
-# 添加项目根目录到路径
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-import config
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DOWNLOADS_DIR = os.path.join(SCRIPT_DIR, 'downloads')
+PROJECT_ROOT = os.path.dirname(os.path.dirname(SCRIPT_DIR))
 
+try:
+    from gallery_dl import config as gdl_config, exception as gdl_exception, job as gdl_job, output as gdl_output
+except ImportError:
+    gdl_config = None  # 未作为Python库安装时，回退到调用gallery-dl命令
 
+# 允许下载的图片扩展名
+IMAGE_FILTER = "extension in ('jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp')"
+
+# 统计图片数量时计入的扩展名
+IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.webp'})
+
+# 批次目录下缓存图片数量的文件，内容为 "<数量> <目录mtime>"，目录有增删时自动失效
+IMAGE_COUNT_FILE = '.count'
+
+# 所有批次共用的下载记录（--global-archive），同一条推文出现在多个批次时只下载一次
+GLOBAL_ARCHIVE_NAME = '.global_archive.txt'
+
+_gdl_config_loaded = False
+
+# extract_name_from_url 使用的正则
+URL_USER_RE = re.compile(r'twitter\.com/([^/\?]+)')
+URL_SEARCH_RE = re.compile(r'q=([^&]+)')
+URL_HASHTAG_RE = re.compile(r'/hashtag/([^/\?]+)')
+
+
+def get_default_config_path():
+    """项目 config.py 中的gallery-dl配置路径（只在调用方未指定 config_path 时才导入 config）"""
+    # 添加项目根目录到路径
+    if PROJECT_ROOT not in sys.path:
+        sys.path.insert(0, PROJECT_ROOT)
+    import config
+    return config.GALLERY_DL_CONFIG_PATH
+
+
+@lru_cache(maxsize=256)
 def extract_name_from_url(url):
-    """从URL提取有意义的名称"""
+    """从URL提取有意义的名称（结果按URL缓存）"""
     
     # 用户主页: https://twitter.com/artist_name
     if '/status/' not in url and '/search' not in url and '/hashtag/' not in url:
-        match = re.search(r'twitter\.com/([^/\?]+)', url)
+        match = URL_USER_RE.search(url)
         if match:
             return match.group(1)
     
     # 搜索: https://twitter.com/search?q=zootopia
     if '/search' in url:
-        match = re.search(r'q=([^&]+)', url)
+        match = URL_SEARCH_RE.search(url)
         if match:
             query = match.group(1).replace('%20', '_')
             return f"search_{query[:20]}"
     
     # 话题: https://twitter.com/hashtag/zootopia
     if '/hashtag/' in url:
-        match = re.search(r'/hashtag/([^/\?]+)', url)
+        match = URL_HASHTAG_RE.search(url)
         if match:
             return f"hashtag_{match.group(1)}"
     
     return "twitter_batch"
 
 
+def count_images(dir_path):
+    """统计目录下的图片数量（scandir的DirEntry自带文件类型，无需逐个stat）"""
+    with os.scandir(dir_path) as it:
+        return sum(1 for entry in it
+                   if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS)
+
+
+def write_image_count(dir_path, count):
+    """记录目录的图片数量（文件先创建再读取目录mtime，写入本身不会使缓存失效）"""
+    with open(os.path.join(dir_path, IMAGE_COUNT_FILE), 'w') as f:
+        f.write(f"{count} {os.stat(dir_path).st_mtime_ns}")
+
+
+def get_image_count(dir_path):
+    """读取缓存的图片数量；没有记录或目录在记录之后有过增删（如手动清洗）时重新统计
+
+    只读：缓存只在下载完成时写入，--list 不会在批次目录中创建文件。
+    """
+    try:
+        with open(os.path.join(dir_path, IMAGE_COUNT_FILE)) as f:
+            count, mtime_ns = map(int, f.read().split())
+        if mtime_ns == os.stat(dir_path).st_mtime_ns:
+            return count
+    except (OSError, ValueError):
+        pass
+    return count_images(dir_path)
+
+
 def list_batches():
     """列出所有已下载的批次"""
-    downloads_dir = os.path.join(os.path.dirname(__file__), 'downloads')
-    
-    if not os.path.exists(downloads_dir):
+    if not os.path.exists(DOWNLOADS_DIR):
         print("没有找到下载批次")
         return
     
     batches = []
-    for dirname in os.listdir(downloads_dir):
-        dir_path = os.path.join(downloads_dir, dirname)
-        if os.path.isdir(dir_path):
+    with os.scandir(DOWNLOADS_DIR) as it:
+        for entry in it:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
             # 统计图片数量
-            image_count = len([f for f in os.listdir(dir_path) 
-                             if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp'))])
+            image_count = get_image_count(entry.path)
             
             # 检查是否有archive文件（判断是否完成）
-            archive_file = os.path.join(dir_path, '.archive.txt')
+            archive_file = os.path.join(entry.path, '.archive.txt')
             status = "已完成" if os.path.exists(archive_file) else "未完成"
             
             batches.append({
-                'name': dirname,
+                'name': entry.name,
                 'count': image_count,
                 'status': status
             })
@@ -85,33 +148,96 @@ def find_existing_batch(url, downloads_dir):
     # 查找所有匹配的目录
     matching_dirs = []
     if os.path.exists(downloads_dir):
-        for dirname in os.listdir(downloads_dir):
-            if dirname.startswith(name + '_'):
-                dir_path = os.path.join(downloads_dir, dirname)
-                if os.path.isdir(dir_path):
-                    matching_dirs.append(dirname)
+        prefix = name + '_'
+        with os.scandir(downloads_dir) as it:
+            for entry in it:
+                if entry.name.startswith(prefix) and entry.is_dir(follow_symlinks=False):
+                    matching_dirs.append(entry.name)
     
-    # 返回最新的目录（按名称排序，时间戳在后面）
-    if matching_dirs:
-        return sorted(matching_dirs)[-1]
-    return None
+    # 返回最新的目录（名称最大者，时间戳在后面）
+    return max(matching_dirs, default=None)
 
 
-def download(url, resume_dir=None, force_new=False, sleep_time=None):
-    """下载Twitter图片"""
-    
-    script_dir = os.path.dirname(__file__)
-    downloads_dir = os.path.join(script_dir, 'downloads')
+def run_gallery_dl(url, output_dir, archive_file, sleep_time=None, config_path=None):
+    """在当前进程内运行gallery-dl，返回退出码（0表示成功）
+
+    配置文件和日志只初始化一次，多次调用时复用gallery-dl内部的HTTP连接池。
+    与命令行方式一致，gallery-dl的错误（如不支持的URL、配置错误）不抛出异常，而是返回非0退出码。
+    """
+    try:
+        return _run_gallery_dl_job(url, output_dir, archive_file, sleep_time, config_path)
+    except gdl_exception.GalleryDLException as e:
+        print(f"gallery-dl错误: {e.__class__.__name__}: {e}")
+        return getattr(e, 'code', 0) or 1
+    except Exception as e:
+        print(f"gallery-dl运行时发生错误: {e.__class__.__name__}: {e}")
+        return 1
+
+
+def _run_gallery_dl_job(url, output_dir, archive_file, sleep_time, config_path):
+    """加载配置并执行一次gallery-dl下载任务，返回退出码"""
+    global _gdl_config_loaded
+    if not _gdl_config_loaded:
+        gdl_output.initialize_logging(logging.INFO)
+        gdl_config.load([config_path])
+        _gdl_config_loaded = True
+
+    # 与命令行参数 --directory / --download-archive / --filter / --write-metadata 等价
+    gdl_config.set((), "base-directory", output_dir)
+    gdl_config.set((), "directory", ())
+    gdl_config.set((), "archive", archive_file)
+    gdl_config.set((), "image-filter", IMAGE_FILTER)
+    gdl_config.set((), "postprocessors", [{"name": "metadata"}])
+
+    # 如果指定了延迟时间（覆盖配置文件）
+    if sleep_time is not None:
+        gdl_config.set((), "sleep-request", sleep_time)
+        gdl_config.set((), "sleep-extractor", sleep_time * 2)
+
+    return gdl_job.DownloadJob(url).run()
+
+
+def run_gallery_dl_command(url, output_dir, archive_file, sleep_time=None, config_path=None):
+    """通过gallery-dl命令行下载（gallery_dl库不可用时使用），返回退出码"""
+    command = [
+        'gallery-dl',
+        '--write-metadata',
+        '--directory', output_dir,
+        '--download-archive', archive_file,
+        '--filter', IMAGE_FILTER,
+        '--config', config_path,
+        #'--abort', '9999',  # 允许大量错误而不中止下载
+        url,
+    ]
+
+    # 如果指定了延迟时间，添加到命令中（覆盖配置文件）
+    if sleep_time is not None:
+        command.extend(['--sleep-request', str(sleep_time)])
+        command.extend(['--sleep-extractor', str(sleep_time * 2)])
+
+    print(f"命令: {' '.join(command)}\n")
+    return subprocess.run(command).returncode
+
+
+def download(url, resume_dir=None, force_new=False, sleep_time=None, global_archive=False, config_path=None):
+    """下载Twitter图片
+
+    可被其他脚本导入后直接调用（如 auto_download.py），失败时以 SystemExit 结束，
+    中断时退出码为130。config_path 默认使用 config.GALLERY_DL_CONFIG_PATH。
+    """
+    config_path = config_path or get_default_config_path()
+    downloads_dir = DOWNLOADS_DIR
     os.makedirs(downloads_dir, exist_ok=True)
     
     # 确定输出目录
     if resume_dir:
         # 用户明确指定了目录
         output_dir = os.path.join(downloads_dir, resume_dir)
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir, exist_ok=True)
+        try:
+            # 直接创建，已存在时由异常区分（不必先检查再创建）
+            Path(output_dir).mkdir(parents=True)
             print(f"\n创建新目录: {resume_dir}")
-        else:
+        except FileExistsError:
             print(f"\n继续下载到: {resume_dir}")
     elif force_new:
         # 用户指定创建新批次
@@ -136,54 +262,46 @@ def download(url, resume_dir=None, force_new=False, sleep_time=None):
             os.makedirs(output_dir, exist_ok=True)
             print(f"\n创建新批次: {dir_name}")
     
-    # 构建gallery-dl命令
     archive_file = os.path.join(output_dir, '.archive.txt')
-    
-    command = [
-        'gallery-dl',
-        '--write-metadata',
-        '--directory', output_dir,
-        '--download-archive', archive_file,
-        '--filter', "extension in ('jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp')",
-        '--config', config.GALLERY_DL_CONFIG_PATH,
-        #'--abort', '9999',  # 允许大量错误而不中止下载
-        url,
-    ]
-    
-    # 如果指定了延迟时间，添加到命令中（覆盖配置文件）
-    if sleep_time is not None:
-        command.extend(['--sleep-request', str(sleep_time)])
-        command.extend(['--sleep-extractor', str(sleep_time * 2)])
-    
+    if global_archive:
+        # 去重使用全局记录；批次内的 .archive.txt 仍在下载完成后创建，用于 --list 显示状态
+        batch_archive_file = archive_file
+        archive_file = os.path.join(downloads_dir, GLOBAL_ARCHIVE_NAME)
+
     print(f"开始下载...")
-    print(f"命令: {' '.join(command)}\n")
-    
+
     try:
-        result = subprocess.run(command, check=True)
-        
-        # 统计下载的图片数量
-        image_count = len([f for f in os.listdir(output_dir) 
-                          if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp'))])
-        
-        print(f"\n{'=' * 70}")
-        print(f"✓ 下载完成！")
-        print(f"  文件保存在: {os.path.basename(output_dir)}")
-        print(f"  共下载 {image_count} 张图片")
-        print(f"\n请手动清洗图片（删除不需要的），然后运行：")
-        print(f"  python tools/batch_twitter/import.py {os.path.basename(output_dir)}")
-        print(f"{'=' * 70}\n")
-        
-    except subprocess.CalledProcessError as e:
-        print(f"\n✗ 下载失败")
-        print(f"如需续传，运行：")
-        print(f"  python tools/batch_twitter/download.py {url} --resume {os.path.basename(output_dir)}")
-        sys.exit(1)
+        if gdl_config is not None:
+            exit_code = run_gallery_dl(url, output_dir, archive_file, sleep_time, config_path)
+        else:
+            exit_code = run_gallery_dl_command(url, output_dir, archive_file, sleep_time, config_path)
     except KeyboardInterrupt:
         print(f"\n\n下载已中断")
         print(f"如需续传，运行：")
         print(f"  python tools/batch_twitter/download.py {url} --resume {os.path.basename(output_dir)}")
+        sys.exit(130)
+
+    if exit_code != 0:
+        print(f"\n✗ 下载失败")
+        print(f"如需续传，运行：")
+        print(f"  python tools/batch_twitter/download.py {url} --resume {os.path.basename(output_dir)}")
         sys.exit(1)
 
+    if global_archive:
+        open(batch_archive_file, 'a').close()
+
+    # 统计下载的图片数量
+    image_count = count_images(output_dir)
+    write_image_count(output_dir, image_count)
+    
+    print(f"\n{'=' * 70}")
+    print(f"✓ 下载完成！")
+    print(f"  文件保存在: {os.path.basename(output_dir)}")
+    print(f"  共下载 {image_count} 张图片")
+    print(f"\n请手动清洗图片（删除不需要的），然后运行：")
+    print(f"  python tools/batch_twitter/import.py {os.path.basename(output_dir)}")
+    print(f"{'=' * 70}\n")
+
 
 def main():
     if len(sys.argv) < 2:
@@ -195,6 +313,7 @@ def main():
         print("  --new                        创建新批次（默认会自动续传现有批次）")
         print("  --resume <directory_name>    续传指定批次")
         print("  --sleep <seconds>            请求延迟（秒），避免rate limit（默认: 1.0）")
+        print("  --global-archive             使用所有批次共用的下载记录，跳过其他批次已下载的图片")
         print("  --list                       列出所有批次")
         sys.exit(1)
     
@@ -206,6 +325,7 @@ def main():
     resume_dir = None
     force_new = False
     sleep_time = None
+    global_archive = False
     
     # 解析参数
     i = 2
@@ -219,6 +339,9 @@ def main():
         elif sys.argv[i] == '--new':
             force_new = True
             i += 1
+        elif sys.argv[i] == '--global-archive':
+            global_archive = True
+            i += 1
         elif sys.argv[i] == '--sleep':
             if i + 1 >= len(sys.argv):
                 print("错误: --sleep 需要指定秒数")
@@ -232,7 +355,7 @@ def main():
         else:
             i += 1
     
-    download(url, resume_dir, force_new, sleep_time)
+    download(url, resume_dir, force_new, sleep_time, global_archive)
 
 
 if __name__ == "__main__":
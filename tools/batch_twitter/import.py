@@ -10,11 +10,35 @@ import json
 import re
 import sqlite3
 import base64
+import hashlib
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import io
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-import imagehash
+import numpy as np
+import scipy.fft
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None  # 可选依赖，未安装时使用标准库的blake2b
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # 可选依赖，未安装时使用标准库json
+
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None  # 可选依赖（SIMD加速的base64），未安装时使用标准库base64
+
+try:
+    import numba
+except ImportError:
+    numba = None  # 可选依赖，未安装时汉明距离只用NumPy计算
 
 # 添加项目根目录到路径
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -27,6 +51,13 @@ import twitter_metadata_parser
 LM_STUDIO_BASE_URL = "http://127.0.0.1:1234/v1"
 LM_STUDIO_MODEL = "local-model"  # LMstudio中的模型名称，通常为"local-model"
 
+# 发送给LLM的图片：视觉模型内部会再缩放到336~448px，较小的图片可以减少图像token和预填充时间
+LLM_IMAGE_SIZE = 560  # 最长边像素，可用 --llm-image-size 修改
+LLM_JPEG_QUALITY = 75
+
+# 可导入的图片扩展名
+IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.webp'})
+
 # 默认开关
 ENABLE_LLM_CLASSIFICATION = True  # 默认启用LLM分类
 DRY_RUN_MODE = False  # 干运行模式：不写入数据库
@@ -52,10 +83,13 @@ Category: fanart
 Classification: sfw"""
 
 
-def resize_image_for_llm(image_path, max_size=896):
+def resize_image_for_llm(image_path, max_size=LLM_IMAGE_SIZE):
     """将图片下采样到指定最长边尺寸"""
     try:
         with Image.open(image_path) as img:
+            # JPEG在解码时直接按1/2、1/4、1/8缩小（不小于目标尺寸），其他格式忽略
+            img.draft('RGB', (max_size, max_size))
+            
             # 获取原始尺寸
             width, height = img.size
             
@@ -71,6 +105,12 @@ def resize_image_for_llm(image_path, max_size=896):
                 new_height = max_size
                 new_width = int(width * max_size / height)
             
+            # 大图先用BOX（区域平均）粗缩到目标尺寸的约2倍，再用LANCZOS缩放到最终尺寸，
+            # 避免LANCZOS直接在原始分辨率上卷积
+            factor = max(width, height) // (2 * max_size)
+            if factor > 1:
+                img = img.resize((width // factor, height // factor), Image.Resampling.BOX)
+            
             # 缩放图片
             resized_img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
             return resized_img
@@ -80,7 +120,20 @@ def resize_image_for_llm(image_path, max_size=896):
         return None
 
 
-def encode_image_to_base64(image_path, max_size=896):
+def flatten_to_rgb(img):
+    """转换为RGB模式，RGBA图片按alpha通道合成到白色背景上（一次NumPy运算完成）"""
+    if img.mode == 'RGB':
+        return img
+    if img.mode != 'RGBA':
+        return img.convert('RGB')
+    
+    arr = np.asarray(img)
+    alpha = arr[:, :, 3:4].astype(np.float32) / 255.0
+    rgb = arr[:, :, :3] * alpha + 255.0 * (1.0 - alpha)
+    return Image.fromarray((rgb + 0.5).astype(np.uint8), 'RGB')
+
+
+def encode_image_to_base64(image_path, max_size=LLM_IMAGE_SIZE):
     """将图片下采样并编码为base64"""
     try:
         # 下采样图片
@@ -88,22 +141,14 @@ def encode_image_to_base64(image_path, max_size=896):
         if resized_img is None:
             return None
         
-        # 转换为JPEG格式并编码
+        # 转换为JPEG格式并编码（透明背景合成为白色）
         buffer = io.BytesIO()
+        resized_img = flatten_to_rgb(resized_img)
+        resized_img.save(buffer, format='JPEG', quality=LLM_JPEG_QUALITY, optimize=False, progressive=False)
         
-        # 如果是RGBA模式，转换为RGB
-        if resized_img.mode == 'RGBA':
-            # 创建白色背景
-            background = Image.new('RGB', resized_img.size, (255, 255, 255))
-            background.paste(resized_img, mask=resized_img.split()[-1])  # 使用alpha通道作为mask
-            resized_img = background
-        elif resized_img.mode != 'RGB':
-            resized_img = resized_img.convert('RGB')
-        
-        resized_img.save(buffer, format='JPEG', quality=85)
-        buffer.seek(0)
-        
-        return base64.b64encode(buffer.getvalue()).decode('utf-8')
+        if pybase64 is not None:
+            return pybase64.b64encode_as_string(buffer.getvalue())
+        return base64.b64encode(buffer.getvalue()).decode('ascii')
         
     except Exception as e:
         print(f"  错误: 无法编码图片 {image_path}: {e}")
@@ -118,15 +163,100 @@ VALID_CLASSIFICATIONS = {'sfw', 'mature', 'nsfw'}
 LLM_MAX_RETRIES = 3
 LLM_RETRY_DELAY = 2  # 秒
 
+# 同时发送给LMstudio的分类请求数（LMstudio会对并发请求做批处理）
+LLM_CONCURRENCY = 4
+# 图片解码、缩放和编码的线程数，在LLM请求进行时提前准备后续图片
+IMAGE_PREP_WORKERS = 4
+
+# 复用到LMstudio的HTTP连接（keep-alive），连接池大小覆盖并发请求数
+LLM_SESSION = requests.Session()
+LLM_SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=max(8, LLM_CONCURRENCY)))
+
+# 导入缓存数据库：按图片内容哈希缓存LLM分类结果，重复运行或相同图片无需再次请求；
+# 按(路径, 修改时间, 大小)缓存pHash，文件未变化时无需重新解码
+IMPORT_CACHE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_cache.db')
+_llm_cache_salts = {}
+
+
+def get_llm_cache_salt():
+    """LLM缓存键的盐值：模型、提示词或发送给模型的图片尺寸/质量变化后旧的缓存自动失效
+    （LLM_IMAGE_SIZE 可由命令行修改，因此按当前设置计算并缓存）"""
+    key = (LLM_IMAGE_SIZE, LLM_JPEG_QUALITY)
+    salt = _llm_cache_salts.get(key)
+    if salt is None:
+        salt = hashlib.sha256(
+            f"{LM_STUDIO_MODEL}\n{LLM_IMAGE_SIZE}\n{LLM_JPEG_QUALITY}\n{SYSTEM_PROMPT}".encode('utf-8')).digest()
+        _llm_cache_salts[key] = salt
+    return salt
+
 
-def classify_with_lmstudio(image_path, enable_streaming=True, max_retries=LLM_MAX_RETRIES):
+def open_import_cache():
+    """打开导入缓存数据库（不存在时创建）"""
+    conn = sqlite3.connect(IMPORT_CACHE_DB)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            hash BLOB PRIMARY KEY,
+            category TEXT NOT NULL,
+            classification TEXT NOT NULL,
+            ts INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS phash_cache (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            phash TEXT NOT NULL
+        )
+    """)
+    return conn
+
+
+def hash_image_content(image_path):
+    """计算图片文件内容的哈希（用作LLM缓存键），读取失败时返回None"""
+    try:
+        with open(image_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if blake3 is not None:
+        hasher = blake3.blake3(get_llm_cache_salt())
+    else:
+        hasher = hashlib.blake2b(get_llm_cache_salt())
+    hasher.update(data)
+    return hasher.digest()[:16]
+
+
+def load_cached_classifications(conn, hashes):
+    """批量查询缓存的分类结果，返回 {hash: (category, classification)}"""
+    cached = {}
+    hashes = list(hashes)
+    for start in range(0, len(hashes), 500):  # SQLite单条语句的参数个数有限制
+        chunk = hashes[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for row in conn.execute(
+                f"SELECT hash, category, classification FROM llm_cache WHERE hash IN ({placeholders})", chunk):
+            cached[row[0]] = (row[1], row[2])
+    return cached
+
+
+def loads_json(data):
+    """解析JSON（str或bytes），安装了orjson时使用orjson"""
+    if orjson is not None:
+        return orjson.loads(data)  # orjson.JSONDecodeError是json.JSONDecodeError的子类
+    return json.loads(data)
+
+
+def classify_with_lmstudio(image_path, enable_streaming=True, max_retries=LLM_MAX_RETRIES, image_data=None):
     """使用LMstudio进行图片分类，支持流式输出。
     
     连接错误或格式解析错误时会重试最多 max_retries 次。
     所有重试耗尽后返回 (None, None)。
+    image_data 为已编码的base64图片，未提供时在此编码。
     """
-    # 编码图片（下采样到896px）- 只做一次
-    image_data = encode_image_to_base64(image_path, max_size=896)
+    # 编码图片（下采样到LLM_IMAGE_SIZE）- 只做一次
+    if image_data is None:
+        image_data = encode_image_to_base64(image_path, max_size=LLM_IMAGE_SIZE)
     if not image_data:
         return None, None
     
@@ -158,7 +288,7 @@ def classify_with_lmstudio(image_path, enable_streaming=True, max_retries=LLM_MA
             }
             
             # 发送请求
-            response = requests.post(
+            response = LLM_SESSION.post(
                 f"{LM_STUDIO_BASE_URL}/chat/completions",
                 json=payload,
                 timeout=60,
@@ -174,13 +304,12 @@ def classify_with_lmstudio(image_path, enable_streaming=True, max_retries=LLM_MA
                 content = ""
                 for line in response.iter_lines():
                     if line:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
+                        if line.startswith(b'data: '):
                             data = line[6:]  # 移除 'data: ' 前缀
-                            if data.strip() == '[DONE]':
+                            if data.strip() == b'[DONE]':
                                 break
                             try:
-                                chunk = json.loads(data)
+                                chunk = loads_json(data)
                                 if 'choices' in chunk and len(chunk['choices']) > 0:
                                     delta = chunk['choices'][0].get('delta', {})
                                     if 'content' in delta:
@@ -192,19 +321,11 @@ def classify_with_lmstudio(image_path, enable_streaming=True, max_retries=LLM_MA
                 print()  # 换行
             else:
                 # 非流式处理
-                result = response.json()
+                result = loads_json(response.content)
                 content = result['choices'][0]['message']['content']
             
             # 解析响应
-            category = None
-            classification = None
-            
-            for line in content.split('\n'):
-                line = line.strip()
-                if line.startswith('Category:'):
-                    category = line.replace('Category:', '').strip().lower()
-                elif line.startswith('Classification:'):
-                    classification = line.replace('Classification:', '').strip().lower()
+            category, classification = artwork_importer.parse_llm_classification(content)
             
             # 验证解析结果是否是合法值
             if category not in VALID_CATEGORIES:
@@ -230,10 +351,112 @@ def classify_with_lmstudio(image_path, enable_streaming=True, max_retries=LLM_MA
     return None, None
 
 
+def iter_classify_images(image_paths, concurrency=None):
+    """并发分类多张图片，返回按输入顺序逐个产出 (图片路径, (category, classification)) 的生成器，失败的为 (None, None)
+
+    调用时即开始在后台分类，调用方处理前面的结果（或等待用户输入）时后面的图片继续分类；
+    内容相同的图片直接使用缓存结果。
+    调用方必须在 finally 中调用返回值的 close()，以取消未完成的请求并写入缓存。
+    并发请求时各图片的输出会交错，因此不使用流式输出，每张完成后打印一行结果。
+    """
+    total = len(image_paths)
+    cache_conn = open_import_cache()
+    executor = ThreadPoolExecutor(max_workers=concurrency or LLM_CONCURRENCY)
+    # 图片准备在单独的线程池中提前进行，LLM请求线程只需等待编码结果
+    prep_executor = ThreadPoolExecutor(max_workers=IMAGE_PREP_WORKERS)
+    new_rows = []
+
+    def finish():
+        # 调用方提前结束时取消尚未开始的请求，已完成的结果仍写入缓存
+        executor.shutdown(wait=False, cancel_futures=True)
+        prep_executor.shutdown(wait=False, cancel_futures=True)
+        with cache_conn:
+            cache_conn.executemany("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)", new_rows)
+        cache_conn.close()
+
+    try:
+        # 先查缓存，只对未命中的图片请求LLM
+        hashes = dict(zip(image_paths, executor.map(hash_image_content, image_paths)))
+        cached = load_cached_classifications(cache_conn, {h for h in hashes.values() if h})
+        source_paths = {}  # 内容相同的图片只请求一次：{图片路径: 实际请求的图片路径}
+        first_path_by_hash = {}
+        for path in image_paths:
+            content_hash = hashes[path]
+            if content_hash in cached:
+                continue
+            if content_hash and content_hash in first_path_by_hash:
+                source_paths[path] = first_path_by_hash[content_hash]
+            else:
+                source_paths[path] = path
+                if content_hash:
+                    first_path_by_hash[content_hash] = path
+        requested = [path for path in image_paths if source_paths.get(path) == path]
+        if len(requested) < total:
+            print(f"  {total - len(requested)} 张图片使用缓存或相同图片的分类结果")
+
+        prep_futures = {path: prep_executor.submit(encode_image_to_base64, path, LLM_IMAGE_SIZE) for path in requested}
+
+        def classify_prepared(path):
+            image_data = prep_futures.pop(path).result()
+            if not image_data:
+                return None, None
+            return classify_with_lmstudio(path, False, image_data=image_data)
+
+        futures = {path: executor.submit(classify_prepared, path) for path in requested}
+    except BaseException:
+        finish()
+        raise
+
+    def results():
+        done = total - len(requested)
+        try:
+            # 预启动停在此处：调用方尚未开始迭代时 close() 也会执行 finally 中的清理
+            yield
+            for path in image_paths:
+                if path not in source_paths:
+                    yield path, cached[hashes[path]]
+                    continue
+                result = futures[source_paths[path]].result()
+                if source_paths[path] == path:
+                    done += 1
+                    category, classification = result
+                    if category and classification:
+                        print(f"  [{done}/{total}] {os.path.basename(path)}: [{category}] [{classification}]")
+                        if hashes[path]:
+                            new_rows.append((hashes[path], category, classification, int(time.time())))
+                    else:
+                        print(f"  [{done}/{total}] {os.path.basename(path)}: 分类失败")
+                yield path, result
+        finally:
+            finish()
+
+    generator = results()
+    next(generator)
+    return generator
+
+
+def classify_images(image_paths, concurrency=None):
+    """并发分类多张图片，返回 {图片路径: (category, classification)}，失败的为 (None, None)"""
+    return dict(iter_classify_images(image_paths, concurrency))
+
+
+def scan_images(dir_path):
+    """列出目录下的图片文件名（scandir的DirEntry自带文件类型，无需逐个stat）"""
+    with os.scandir(dir_path) as entries:
+        return [entry.name for entry in entries
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS]
+
+
+def list_metadata_files(target_dir):
+    """一次扫描批次目录，返回其中所有JSON元数据文件名的集合"""
+    with os.scandir(target_dir) as entries:
+        return {entry.name for entry in entries if entry.name.endswith('.json') and entry.is_file()}
+
+
 def parse_gallery_dl_metadata(json_path):
     """解析gallery-dl生成的JSON元数据"""
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    with open(json_path, 'rb') as f:
+        data = loads_json(f.read())
     
     # 提取多图信息
     image_position = data.get('num', 1)
@@ -273,8 +496,7 @@ def preview_import(directory, enable_llm=True):
         print(f"错误: related子目录不存在: {related_dir}")
         sys.exit(1)
     
-    image_files = [f for f in os.listdir(related_dir) 
-                   if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp'))]
+    image_files = scan_images(related_dir)
     
     if not image_files:
         print(f"错误: related目录中没有找到图片文件")
@@ -289,15 +511,22 @@ def preview_import(directory, enable_llm=True):
     
     will_import = 0
     will_skip = 0
+    preview_files = []
+    
+    metadata_files = list_metadata_files(target_dir)
     
     conn = sqlite3.connect(config.DB_FILE)
-    cursor = conn.cursor()
+    # 一次性加载已有作品的(平台, 作者, 标题)，避免每个文件查询一次数据库
+    existing_titles = set(conn.execute(
+        "SELECT source_platform, artist, title FROM artworks WHERE title IS NOT NULL AND title != ''"
+    ))
+    conn.close()
     
     for filename in sorted(image_files):
         # gallery-dl的JSON文件名格式是 filename.jpg.json
         json_path = os.path.join(target_dir, filename + '.json')
         
-        if not os.path.exists(json_path):
+        if filename + '.json' not in metadata_files:
             print(f"⚠ {filename} - 跳过（无元数据）")
             will_skip += 1
             continue
@@ -312,11 +541,7 @@ def preview_import(directory, enable_llm=True):
             
             # 检查重复
             if metadata.get('title'):
-                cursor.execute(
-                    "SELECT id FROM artworks WHERE source_platform = ? AND artist = ? AND title = ?",
-                    (metadata['platform'], metadata['artist'], metadata['title'])
-                )
-                if cursor.fetchone():
+                if (metadata['platform'], metadata['artist'], metadata['title']) in existing_titles:
                     print(f"⚠ {filename} - 跳过（已存在）")
                     will_skip += 1
                     continue
@@ -326,28 +551,19 @@ def preview_import(directory, enable_llm=True):
             if metadata.get('_total_images', 1) > 1:
                 multi_info = f" [{metadata['_image_position']}/{metadata['_total_images']}]"
             
-            # LLM分类预览
-            llm_info = ""
-            if enable_llm:
-                image_path = os.path.join(related_dir, filename)
-                print(f"  🤖 正在分析: {filename}...")
-                print(f"     ", end="", flush=True)
-                category, classification = classify_with_lmstudio(image_path, enable_streaming=True)
-                if category and classification:
-                    llm_info = f" [{category}] [{classification}]"
-                    print(f"\n     结果: {llm_info}")
-                else:
-                    print(f"\n     结果: 分类失败")
-            
-            print(f"✓ {filename}{multi_info}{llm_info}")
+            print(f"✓ {filename}{multi_info}")
             print(f"  → {metadata['artist']}: {metadata['title'][:60]}")
             will_import += 1
+            preview_files.append(filename)
             
         except Exception as e:
             print(f"✗ {filename} - 错误: {e}")
             will_skip += 1
     
-    conn.close()
+    # LLM分类预览（并发请求）
+    if enable_llm and preview_files:
+        print(f"\n🤖 LLM分析 {len(preview_files)} 张图片（并发 {LLM_CONCURRENCY}）...")
+        classify_images([os.path.join(related_dir, filename) for filename in preview_files])
     
     print("=" * 70)
     print(f"总计: {will_import} 张将导入, {will_skip} 张将跳过")
@@ -355,52 +571,208 @@ def preview_import(directory, enable_llm=True):
 
 
 def load_all_phashes(conn):
-    """一次性加载所有phash到内存"""
+    """一次性加载所有phash到内存，哈希存为连续的uint64数组，其余字段按相同顺序存为列表"""
     cursor = conn.execute("SELECT id, phash, file_name, artist, title FROM artworks WHERE phash IS NOT NULL")
-    all_hashes = []
+    ids, hashes, file_names, artists, titles = [], [], [], [], []
     
     for row in cursor.fetchall():
         try:
-            all_hashes.append({
-                'id': row[0],
-                'hash': imagehash.hex_to_hash(row[1]),
-                'file_name': row[2],
-                'artist': row[3],
-                'title': row[4]
-            })
-        except Exception:
+            if len(row[1]) != 16:  # 只比较64位pHash
+                continue
+            hashes.append(int(row[1], 16))
+        except (TypeError, ValueError):
             continue
+        ids.append(row[0])
+        file_names.append(row[2])
+        artists.append(row[3])
+        titles.append(row[4])
     
-    return all_hashes
+    hashes = np.array(hashes, dtype=np.uint64)
+    return {
+        'ids': ids,
+        'hashes': hashes,
+        'segment_index': build_segment_index(hashes),
+        'file_names': file_names,
+        'artists': artists,
+        'titles': titles,
+    }
+
+
+# 鸽巢预筛选：64位哈希分成4段16位，汉明距离不超过3的两个哈希至少有一段完全相同
+PHASH_SEGMENT_COUNT = 4
+PHASH_SEGMENT_BITS = 16
+
+
+def get_hash_segment(hashes, segment):
+    """取出哈希的第segment段（hashes可以是uint64数组或np.uint64标量）"""
+    return (hashes >> np.uint64(segment * PHASH_SEGMENT_BITS)) & np.uint64((1 << PHASH_SEGMENT_BITS) - 1)
+
+
+def build_segment_index(hashes):
+    """为每一段建立排序索引 [(按该段值排序的下标, 排序后的段值)]，查询时二分查找相同段的哈希"""
+    index = []
+    for segment in range(PHASH_SEGMENT_COUNT):
+        values = get_hash_segment(hashes, segment)
+        order = np.argsort(values, kind='stable')
+        index.append((order, values[order]))
+    return index
+
+
+def find_candidate_indices(segment_index, query_hash):
+    """返回至少有一段与query_hash相同的哈希下标（已排序去重）"""
+    query = np.uint64(query_hash)
+    candidates = []
+    for segment, (order, sorted_values) in enumerate(segment_index):
+        value = get_hash_segment(query, segment)
+        start = np.searchsorted(sorted_values, value, side='left')
+        end = np.searchsorted(sorted_values, value, side='right')
+        candidates.append(order[start:end])
+    return np.unique(np.concatenate(candidates))
+
+
+# 每个字节值包含的1的个数（NumPy 2.0以下没有np.bitwise_count时使用）
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
 
 
-def find_similar_images(image_path, all_hashes, threshold=1):
-    """查找相似图片（使用预加载的hash列表）"""
+# 哈希数量超过该值且安装了numba时，用多线程JIT编译的扫描计算汉明距离
+NUMBA_MIN_HASHES = 10_000
+
+if numba is not None:
+    # SWAR popcount用到的常量（必须是uint64，否则numba会把运算提升为float64）
+    _POPCOUNT_M1 = np.uint64(0x5555555555555555)
+    _POPCOUNT_M2 = np.uint64(0x3333333333333333)
+    _POPCOUNT_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+    _POPCOUNT_H01 = np.uint64(0x0101010101010101)
+
+    @numba.njit(parallel=True, cache=True)
+    def _hamming_distances_jit(hashes, query_hash):
+        distances = np.empty(len(hashes), dtype=np.uint8)
+        for i in numba.prange(len(hashes)):
+            x = hashes[i] ^ query_hash
+            x = x - ((x >> np.uint64(1)) & _POPCOUNT_M1)
+            x = (x & _POPCOUNT_M2) + ((x >> np.uint64(2)) & _POPCOUNT_M2)
+            x = (x + (x >> np.uint64(4))) & _POPCOUNT_M4
+            distances[i] = (x * _POPCOUNT_H01) >> np.uint64(56)
+        return distances
+
+
+def hamming_distances(hashes, query_hash):
+    """计算query_hash与数组中每个64位哈希的汉明距离（向量化，不逐个比较）"""
+    if numba is not None and len(hashes) > NUMBA_MIN_HASHES:
+        return _hamming_distances_jit(hashes, np.uint64(query_hash))
+    diff = hashes ^ np.uint64(query_hash)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(diff)
+    return POPCOUNT_TABLE[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+# pHash参数（与imagehash.phash的默认值一致，保证与数据库中已有的哈希可比）
+PHASH_IMAGE_SIZE = 32
+PHASH_HASH_SIZE = 8
+
+
+def load_phash_pixels(image_path):
+    """读取图片并缩放为pHash使用的灰度像素矩阵，失败时返回None"""
     try:
-        # 计算当前图片的phash
         with Image.open(image_path) as img:
-            query_hash = imagehash.phash(img)
-        
-        similar = []
-        for item in all_hashes:
-            try:
-                distance = query_hash - item['hash']
-                if distance < threshold:
-                    similar.append({
-                        'id': item['id'],
-                        'distance': distance,
-                        'file_name': item['file_name'],
-                        'artist': item['artist'],
-                        'title': item['title']
-                    })
-            except Exception:
-                continue
-        
-        return sorted(similar, key=lambda x: x['distance'])
-    
+            img = img.convert('L').resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.Resampling.LANCZOS)
+            return np.asarray(img)
     except Exception as e:
-        print(f"  ⚠ 无法计算相似度: {e}")
+        print(f"  ⚠ 无法计算相似度: {os.path.basename(image_path)}: {e}")
+        return None
+
+
+def get_phashes(image_paths):
+    """获取图片的pHash，返回 {图片路径: 64位整数}；文件未变化时使用缓存，其余批量计算后写入缓存"""
+    results = {}
+    file_keys = {}
+    for path in image_paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        file_keys[os.path.abspath(path)] = (path, st.st_mtime_ns, st.st_size)
+
+    cache_conn = open_import_cache()
+    abs_paths = list(file_keys)
+    for start in range(0, len(abs_paths), 500):  # SQLite单条语句的参数个数有限制
+        chunk = abs_paths[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for abs_path, mtime_ns, size, phash in cache_conn.execute(
+                f"SELECT path, mtime_ns, size, phash FROM phash_cache WHERE path IN ({placeholders})", chunk):
+            path, cur_mtime_ns, cur_size = file_keys[abs_path]
+            if (mtime_ns, size) == (cur_mtime_ns, cur_size):
+                results[path] = int(phash, 16)
+
+    missing = [path for path, _, _ in file_keys.values() if path not in results]
+    if missing:
+        computed = compute_phashes(missing)
+        results.update(computed)
+        rows = []
+        for abs_path, (path, mtime_ns, size) in file_keys.items():
+            if path in computed:
+                rows.append((abs_path, mtime_ns, size, f"{computed[path]:016x}"))
+        with cache_conn:
+            cache_conn.executemany("INSERT OR REPLACE INTO phash_cache VALUES (?, ?, ?, ?)", rows)
+    cache_conn.close()
+
+    if len(missing) < len(file_keys):
+        print(f"  {len(file_keys) - len(missing)} 张图片使用缓存的哈希")
+    return results
+
+
+def compute_phashes(image_paths):
+    """批量计算pHash，结果与imagehash.phash相同，返回 {图片路径: 64位整数}（失败的图片不在结果中）
+
+    解码和缩放在线程池中并行，DCT对所有图片一次性完成。
+    """
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        pixels = list(executor.map(load_phash_pixels, image_paths))
+
+    valid = [(path, px) for path, px in zip(image_paths, pixels) if px is not None]
+    if not valid:
+        return {}
+
+    stack = np.stack([px for _, px in valid]).astype(np.float64)
+    # 二维DCT-II（与imagehash先后沿两个轴调用scipy.fftpack.dct等价），取左上角低频部分
+    dct = scipy.fft.dctn(stack, type=2, axes=(1, 2))[:, :PHASH_HASH_SIZE, :PHASH_HASH_SIZE]
+    low_freq = dct.reshape(len(valid), -1)
+    bits = low_freq > np.median(low_freq, axis=1, keepdims=True)
+    # 按行优先、高位在前打包为64位整数，与imagehash的十六进制表示一致
+    hashes = np.packbits(bits, axis=1).view('>u8').ravel()
+    return {path: int(h) for (path, _), h in zip(valid, hashes)}
+
+
+def find_similar_images(query_hash, all_hashes, threshold=1):
+    """查找相似图片（query_hash为compute_phashes计算的整数，使用预加载的hash数组）"""
+    if len(all_hashes['hashes']) == 0:
         return []
+    
+    if threshold - 1 < PHASH_SEGMENT_COUNT:
+        # 允许的最大距离小于段数时，相似的哈希必有一段相同，只需比较预筛选出的候选
+        candidates = find_candidate_indices(all_hashes['segment_index'], query_hash)
+        distances = hamming_distances(all_hashes['hashes'][candidates], query_hash)
+    else:
+        candidates = np.arange(len(all_hashes['hashes']))
+        distances = hamming_distances(all_hashes['hashes'], query_hash)
+    
+    order = np.argsort(distances, kind='stable')
+    order = order[distances[order] < threshold]
+    
+    return [{
+        'id': all_hashes['ids'][i],
+        'distance': int(distances[j]),
+        'file_name': all_hashes['file_names'][i],
+        'artist': all_hashes['artists'][i],
+        'title': all_hashes['titles'][i]
+    } for i, j in zip(candidates[order], order)]
+
+
+def write_lines(lines):
+    """把攒下的多行输出一次写到stdout并清空列表"""
+    if lines:
+        sys.stdout.write('\n'.join(lines) + '\n')
+        lines.clear()
 
 
 def ask_user_decision(filename, similar_images):
@@ -446,17 +818,14 @@ def import_batch(directory, check_duplicates=True, threshold=1, interactive=Fals
         sys.exit(1)
     
     try:
-        all_files = os.listdir(related_dir)
+        image_files = scan_images(related_dir)
     except Exception as e:
         print(f"错误: 无法读取related目录: {e}")
         sys.exit(1)
     
-    image_files = [f for f in all_files 
-                   if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp'))]
-    
     if not image_files:
         print(f"错误: related目录中没有找到图片文件")
-        print(f"related目录内容: {len(all_files)} 个文件")
+        print(f"related目录内容: {len(os.listdir(related_dir))} 个文件")
         sys.exit(1)
     
     print(f"\n开始导入: {directory}")
@@ -476,30 +845,40 @@ def import_batch(directory, check_duplicates=True, threshold=1, interactive=Fals
     error_count = 0
     
     conn = sqlite3.connect(config.DB_FILE)
+    # WAL模式下提交不阻塞读取，NORMAL同步级别配合批量提交减少fsync次数
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
     
     # 预加载所有phash（优化性能）
-    all_hashes = []
+    all_hashes = None
     if check_duplicates:
         print("加载数据库中的图片哈希...")
         all_hashes = load_all_phashes(conn)
-        print(f"已加载 {len(all_hashes)} 张图片的哈希值")
+        print(f"已加载 {len(all_hashes['ids'])} 张图片的哈希值")
         
-        # 预计算待导入图片的phash（可选优化）
-        if len(image_files) > 10:
-            print(f"预计算 {len(image_files)} 张待导入图片的哈希...")
+        # 一次性批量计算待导入图片的phash
+        print(f"计算 {len(image_files)} 张待导入图片的哈希...")
+        query_hashes = get_phashes([os.path.join(related_dir, f) for f in image_files])
         
         print("=" * 70)
     
+    metadata_files = list_metadata_files(target_dir)
+    
+    # 第一阶段：解析元数据并检查相似度，确定需要导入的图片
+    candidates = []  # [(序号, 文件名, 图片路径, 元数据)]
+    pending_decisions = []  # 交互模式下等待用户决定的相似图片：[(序号, 文件名, 相似图片)]
+    lines = []  # 当前图片的输出，攒齐后一次写出
     for idx, filename in enumerate(sorted(image_files), 1):
+        write_lines(lines)
         image_path = os.path.join(related_dir, filename)
         # gallery-dl的JSON文件名格式是 filename.jpg.json，不是 filename.json
         # 元数据文件仍然在主目录中
         json_path = os.path.join(target_dir, filename + '.json')
         
-        print(f"\n[{idx}/{len(image_files)}] 处理: {filename}")
+        lines.append(f"\n[{idx}/{len(image_files)}] 检查: {filename}")
         
-        if not os.path.exists(json_path):
-            print(f"  ⚠ 跳过: 没有找到元数据文件 (需要 {os.path.basename(json_path)})")
+        if filename + '.json' not in metadata_files:
+            lines.append(f"  ⚠ 跳过: 没有找到元数据文件 (需要 {os.path.basename(json_path)})")
             skip_count += 1
             continue
         
@@ -508,114 +887,142 @@ def import_batch(directory, check_duplicates=True, threshold=1, interactive=Fals
             metadata = parse_gallery_dl_metadata(json_path)
             
             if not metadata['artist']:
-                print(f"  ⚠ 跳过: 无法提取作者信息")
+                lines.append(f"  ⚠ 跳过: 无法提取作者信息")
                 skip_count += 1
                 continue
             
             # 显示多图信息
             if metadata.get('_total_images', 1) > 1:
-                print(f"  📷 多图帖子: {metadata['_image_position']}/{metadata['_total_images']}")
+                lines.append(f"  📷 多图帖子: {metadata['_image_position']}/{metadata['_total_images']}")
             
             # 相似度检查
             if check_duplicates:
-                similar_images = find_similar_images(image_path, all_hashes, threshold)
+                query_hash = query_hashes.get(image_path)
+                similar_images = find_similar_images(query_hash, all_hashes, threshold) if query_hash is not None else []
                 if similar_images:
                     if interactive:
-                        # 交互模式：询问用户
-                        decision = ask_user_decision(filename, similar_images)
-                        
-                        if decision == 's':
-                            print(f"  ⊘ 跳过")
-                            skip_count += 1
-                            continue
-                        elif decision == 'q':
-                            print(f"\n用户中止导入")
-                            break
-                        elif decision == 'v':
-                            # 显示详细信息
-                            print(f"\n  详细信息:")
-                            for sim in similar_images[:5]:
-                                print(f"    ID:{sim['id']:06d} 距离:{sim['distance']}")
-                                print(f"    文件: {sim['file_name']}")
-                                print(f"    作者: {sim['artist']}")
-                                print(f"    标题: {sim['title']}")
-                                print()
-                            
-                            # 再次询问
-                            decision = ask_user_decision(filename, similar_images)
-                            if decision == 's':
-                                print(f"  ⊘ 跳过")
-                                skip_count += 1
-                                continue
-                            elif decision == 'q':
-                                print(f"\n用户中止导入")
-                                break
-                        # decision == 'k': 继续导入
+                        # 交互模式：先记录下来，LLM分类开始后再询问用户，等待输入时分类在后台进行
+                        lines.append(f"  ⚠ 发现 {len(similar_images)} 张相似图片，稍后询问")
+                        pending_decisions.append((idx, filename, similar_images))
                     else:
                         # 非交互模式：自动跳过
-                        print(f"  ⊘ 跳过 (发现 {len(similar_images)} 张相似图片，距离: {similar_images[0]['distance']})")
+                        lines.append(f"  ⊘ 跳过 (发现 {len(similar_images)} 张相似图片，距离: {similar_images[0]['distance']})")
                         skip_count += 1
                         continue
             
-            # LLM分类
-            llm_category = None
-            llm_classification = None
-            if enable_llm:
-                print(f"  🤖 LLM分析中...")
-                print(f"     ", end="", flush=True)
-                llm_category, llm_classification = classify_with_lmstudio(image_path, enable_streaming=True)
+            candidates.append((idx, filename, image_path, metadata))
+                
+        except Exception as e:
+            lines.append(f"  ✗ 错误: {e}")
+            error_count += 1
+    write_lines(lines)
+    
+    # 第二阶段：并发进行LLM分类（LMstudio可同时处理多个请求），按顺序写入数据库，
+    # 写入前面的图片时后面的图片继续在后台分类
+    if enable_llm and candidates:
+        print(f"\n🤖 LLM分析 {len(candidates)} 张图片（并发 {LLM_CONCURRENCY}）...")
+        llm_results = iter_classify_images([image_path for _, _, image_path, _ in candidates])
+    else:
+        llm_results = ((image_path, (None, None)) for _, _, image_path, _ in candidates)
+    
+    # 询问用户、导入过程中出错或中止时，都在finally中结束后台分类（取消未开始的请求）
+    try:
+        # 询问用户如何处理相似图片（LLM分类同时在后台进行）
+        rejected = set()  # 用户选择跳过的序号
+        abort_idx = None  # 用户选择退出时的序号，该图片及之后的图片都不导入
+        for idx, filename, similar_images in pending_decisions:
+            print(f"\n[{idx}/{len(image_files)}] 检查: {filename}")
+            decision = ask_user_decision(filename, similar_images)
+            if decision == 'v':
+                # 显示详细信息
+                print(f"\n  详细信息:")
+                for sim in similar_images[:5]:
+                    print(f"    ID:{sim['id']:06d} 距离:{sim['distance']}")
+                    print(f"    文件: {sim['file_name']}")
+                    print(f"    作者: {sim['artist']}")
+                    print(f"    标题: {sim['title']}")
+                    print()
+            
+                # 再次询问
+                decision = ask_user_decision(filename, similar_images)
+        
+            if decision == 's':
+                print(f"  ⊘ 跳过")
+                skip_count += 1
+                rejected.add(idx)
+            elif decision == 'q':
+                print(f"\n用户中止导入")
+                abort_idx = idx
+                break
+            # decision == 'k': 继续导入
+    
+        for (idx, filename, image_path, metadata), (_, (llm_category, llm_classification)) in zip(candidates, llm_results):
+            if abort_idx is not None and idx >= abort_idx:
+                break
+            if idx in rejected:
+                continue
+            if enable_llm and not (llm_category and llm_classification):
+                print(f"\n  ✗ {filename} 的LLM分类在{LLM_MAX_RETRIES}次重试后仍然失败，中止导入。")
+                print(f"    请检查LMstudio是否正在运行: {LM_STUDIO_BASE_URL}")
+                sys.exit(1)
+        
+            lines = [f"\n[{idx}/{len(image_files)}] 导入: {filename}"]
+        
+            try:
+                # LLM分类
                 if llm_category and llm_classification:
-                    print(f"     结果: [{llm_category}] [{llm_classification}]")
                     # 更新metadata中的分类信息
                     metadata['category'] = llm_category
                     metadata['classification'] = llm_classification
-                else:
-                    print(f"\n  ✗ LLM分类在{LLM_MAX_RETRIES}次重试后仍然失败，中止导入。")
-                    print(f"    请检查LMstudio是否正在运行: {LM_STUDIO_BASE_URL}")
-                    conn.close()
-                    sys.exit(1)
             
-            # 干运行模式
-            if dry_run:
-                print(f"  ✓ 干运行: 将导入 (模拟)")
-                title_display = metadata.get('title') or '(无标题)'
-                print(f"     {metadata['artist']}: {title_display[:60]}")
-                if enable_llm and llm_category and llm_classification:
-                    print(f"     分类: {llm_category} / {llm_classification}")
-                success_count += 1
-                continue
+                # 干运行模式
+                if dry_run:
+                    lines.append(f"  ✓ 干运行: 将导入 (模拟)")
+                    title_display = metadata.get('title') or '(无标题)'
+                    lines.append(f"     {metadata['artist']}: {title_display[:60]}")
+                    if enable_llm and llm_category and llm_classification:
+                        lines.append(f"     分类: {llm_category} / {llm_classification}")
+                    success_count += 1
+                    continue
             
-            # 调用统一入库接口
-            success, artwork_id, error = artwork_importer.add_artwork_to_database(
-                file_path=image_path,
-                metadata=metadata,
-                move_file=True,
-                db_connection=conn,
-                check_duplicate=True
-            )
+                # 调用统一入库接口
+                success, artwork_id, error = artwork_importer.add_artwork_to_database(
+                    file_path=image_path,
+                    metadata=metadata,
+                    move_file=True,
+                    db_connection=conn,
+                    check_duplicate=True
+                )
             
-            if success:
-                print(f"  ✓ 成功导入 (ID: {artwork_id:06d})")
-                # 安全地显示标题
-                title_display = metadata.get('title') or '(无标题)'
-                print(f"     {metadata['artist']}: {title_display[:60]}")
-                if enable_llm and llm_category and llm_classification:
-                    print(f"     分类: {llm_category} / {llm_classification}")
-                conn.commit()
-                success_count += 1
-            else:
-                if "Duplicate" in error:
-                    print(f"  ⚠ 跳过: {error}")
-                    skip_count += 1
+                if success:
+                    lines.append(f"  ✓ 成功导入 (ID: {artwork_id:06d})")
+                    # 安全地显示标题
+                    title_display = metadata.get('title') or '(无标题)'
+                    lines.append(f"     {metadata['artist']}: {title_display[:60]}")
+                    if enable_llm and llm_category and llm_classification:
+                        lines.append(f"     分类: {llm_category} / {llm_classification}")
+                    # 文件已被移动到最终位置，立即提交，进程被强制终止时记录也不会丢失
+                    # （WAL + synchronous=NORMAL 下每次提交的开销很小）
+                    conn.commit()
+                    success_count += 1
                 else:
-                    print(f"  ✗ 失败: {error}")
-                    error_count += 1
+                    if "Duplicate" in error:
+                        lines.append(f"  ⚠ 跳过: {error}")
+                        skip_count += 1
+                    else:
+                        lines.append(f"  ✗ 失败: {error}")
+                        error_count += 1
                 
-        except Exception as e:
-            print(f"  ✗ 错误: {e}")
-            error_count += 1
+            except Exception as e:
+                lines.append(f"  ✗ 错误: {e}")
+                error_count += 1
+            finally:
+                write_lines(lines)
     
-    conn.close()
+    finally:
+        llm_results.close()
+        conn.commit()
+        conn.close()
     
     print("\n" + "=" * 70)
     print(f"导入完成！")
@@ -634,20 +1041,20 @@ def list_available_batches():
         return []
     
     batches = []
-    for dirname in os.listdir(downloads_dir):
-        dir_path = os.path.join(downloads_dir, dirname)
-        if os.path.isdir(dir_path):
-            # 检查related子目录中的图片数量
-            related_dir = os.path.join(dir_path, 'related')
-            if os.path.exists(related_dir) and os.path.isdir(related_dir):
-                image_count = len([f for f in os.listdir(related_dir) 
-                                 if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp'))])
-                if image_count > 0:
-                    batches.append({
-                        'name': dirname,
-                        'count': image_count,
-                        'path': dir_path
-                    })
+    with os.scandir(downloads_dir) as entries:
+        batch_dirs = [entry for entry in entries if entry.is_dir()]
+    for entry in batch_dirs:
+        dir_path = entry.path
+        # 检查related子目录中的图片数量
+        related_dir = os.path.join(dir_path, 'related')
+        if os.path.isdir(related_dir):
+            image_count = len(scan_images(related_dir))
+            if image_count > 0:
+                batches.append({
+                    'name': entry.name,
+                    'count': image_count,
+                    'path': dir_path
+                })
     
     return sorted(batches, key=lambda x: x['name'], reverse=False)
 
@@ -794,7 +1201,7 @@ def import_all_batches(check_duplicates=True, threshold=1, interactive=False, en
 
 
 def main():
-    global ENABLE_LLM_CLASSIFICATION, DRY_RUN_MODE
+    global ENABLE_LLM_CLASSIFICATION, DRY_RUN_MODE, LLM_IMAGE_SIZE
     
     # 解析参数
     check_duplicates = True
@@ -834,6 +1241,17 @@ def main():
             except ValueError:
                 pass
     
+    # 检查是否有 --llm-image-size 参数
+    if '--llm-image-size' in sys.argv:
+        idx = sys.argv.index('--llm-image-size')
+        if idx + 1 < len(sys.argv):
+            try:
+                LLM_IMAGE_SIZE = int(sys.argv[idx + 1])
+                sys.argv.pop(idx)  # 移除 --llm-image-size
+                sys.argv.pop(idx)  # 移除尺寸值
+            except ValueError:
+                pass
+    
     if len(sys.argv) == 1:
         # 无参数：交互式模式
         interactive_import()
@@ -853,6 +1271,7 @@ def main():
         print("  --no-llm                     禁用LLM分类 (默认启用)")
         print("  --dry-run                    干运行模式：不写入数据库")
         print("  --threshold <n>              设置相似度阈值 (默认: 1)")
+        print(f"  --llm-image-size <px>        发送给LLM的图片最长边 (默认: {LLM_IMAGE_SIZE})")
         print("  --interactive                发现相似时询问用户 (默认自动跳过)")
         print("  --help, -h                   显示帮助信息")
         print("\n指定批次:")
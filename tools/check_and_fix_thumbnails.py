@@ -9,57 +9,88 @@ sys.path.insert(0, str(PROJECT_ROOT))
 os.chdir(PROJECT_ROOT)  # 切换工作目录到项目根目录
 
 import sqlite3
+from collections import Counter
+from functools import partial
+from tqdm import tqdm
+from worker_utils import create_image_pool
 import config
+import utils
+from db_utils import open_db
 from PIL import Image, UnidentifiedImageError
 
+DB_FILE = config.DB_FILE
 THUMBNAIL_DIR = config.THUMBNAIL_DIR
 THUMBNAIL_SIZE = config.THUMBNAIL_SIZE
+THUMBNAIL_QUALITY = config.THUMBNAIL_QUALITY
+
+# 缩略图生成和校验是CPU密集的，按文件分给多个进程并行处理
+WORKER_CHUNKSIZE = 16
+
+# JPEG编码器可以直接保存、不需要先转换为RGB的模式（灰度图直接保存为灰度JPEG）
+JPEG_DIRECT_MODES = ('RGB', 'L')
+
+# JPEG解码时缩小到缩略图最终尺寸的几倍（与Image.thumbnail默认的reducing_gap一致，保证缩放质量）
+THUMBNAIL_DRAFT_GAP = 2
 
 
 def setup_database_connection():
     """建立数据库连接"""
-    conn = sqlite3.connect(config.DB_FILE)
+    conn = open_db(DB_FILE)
     conn.row_factory = sqlite3.Row  # 让返回的行可以像字典一样访问
     return conn
 
 
-def get_records_with_null_thumbnails(conn):
-    """获取所有thumbnail_filename为NULL的记录"""
+def get_thumbnail_records(conn):
+    """获取需要检查缩略图的记录：thumbnail_filename为NULL（需要生成）或非空（需要检查文件）"""
     cursor = conn.cursor()
-    cursor.execute("SELECT id, file_path FROM artworks WHERE thumbnail_filename IS NULL")
+    cursor.execute("""
+        SELECT id, file_path, thumbnail_filename FROM artworks
+        WHERE thumbnail_filename IS NULL OR thumbnail_filename != ''
+    """)
     return cursor.fetchall()
 
 
-def get_all_artwork_records(conn):
-    """获取所有artwork记录用于检查缩略图文件是否存在"""
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, file_path, thumbnail_filename FROM artworks")
-    return cursor.fetchall()
+def draft_for_thumbnail(img):
+    """让JPEG在解码时直接按1/2、1/4、1/8缩小，只解码到缩略图实际尺寸的THUMBNAIL_DRAFT_GAP倍
+
+    Image.thumbnail自带的draft按整个THUMBNAIL_SIZE边框计算，边框很高时大多数图片不会被缩小解码。
+    """
+    width, height = img.size
+    ratio = min(THUMBNAIL_SIZE[0] / width, THUMBNAIL_SIZE[1] / height)
+    if ratio < 1:
+        img.draft('RGB', (max(1, int(width * ratio * THUMBNAIL_DRAFT_GAP)),
+                          max(1, int(height * ratio * THUMBNAIL_DRAFT_GAP))))
+
 
+def init_thumbnail_worker(thumb_dir):
+    """进程池初始化：每个工作进程只创建一次缩略图目录，任务中不再检查"""
+    os.makedirs(thumb_dir, exist_ok=True)
 
-def create_thumbnail(full_path, thumbnail_filename):
-    """为指定图片创建缩略图"""
+
+def create_thumbnail(full_path, thumb_path):
+    """为指定图片创建缩略图并保存到thumb_path（已存在的缩略图会被直接覆盖）"""
     try:
-        thumb_path = os.path.join(THUMBNAIL_DIR, thumbnail_filename)
-        
-        # 如果缩略图已存在，先删除它
-        if os.path.exists(thumb_path):
-            os.remove(thumb_path)
-        
         with Image.open(full_path) as img:
+            draft_for_thumbnail(img)
             img.thumbnail(THUMBNAIL_SIZE)
-            # 确保保存时是RGB，避免一些PNG格式问题
-            if img.mode != 'RGB':
+            # 透明、调色板、CMYK等模式转换为RGB，避免一些PNG格式问题；RGB和灰度图直接保存
+            if img.mode not in JPEG_DIRECT_MODES:
                 img = img.convert('RGB')
-            img.save(thumb_path, "JPEG", quality=config.THUMBNAIL_QUALITY)
+            img.save(thumb_path, "JPEG", quality=THUMBNAIL_QUALITY, subsampling=2,
+                     optimize=False, progressive=False)
         return True
     except Exception as e:
-        print(f"  [!] 无法创建缩略图 {thumbnail_filename}: {e}")
+        print(f"  [!] 无法创建缩略图 {thumb_path}: {e}")
         return False
 
 
-def is_thumbnail_valid(thumb_path):
-    """检查缩略图文件是否有效"""
+def is_thumbnail_valid(thumb_path, deep=False):
+    """检查缩略图文件是否有效
+
+    默认只检查文件头和结束标记（能发现缺失和截断的文件），deep为True时用verify()完整校验。
+    """
+    if not deep:
+        return utils.is_image_file_complete(thumb_path)
     try:
         if not os.path.exists(thumb_path):
             return False
@@ -70,84 +101,78 @@ def is_thumbnail_valid(thumb_path):
         return False
 
 
-def fix_null_thumbnails(conn):
-    """修复thumbnail_filename为NULL的记录"""
-    null_records = get_records_with_null_thumbnails(conn)
-    fixed_count = 0
+def fix_thumbnail_worker(task, deep=False):
+    """进程池任务：检查一条记录的缩略图，缺失或损坏时重新生成
+
+    task为 (artwork_id, 原图路径, 缩略图文件名, 缩略图路径, 是否为新生成, 原图是否存在)，
+    返回 (task, 状态)，状态为 'valid'、'missing_source'、'created' 或 'failed'。
+    """
+    artwork_id, full_path, thumbnail_filename, thumb_path, is_new, source_exists = task
+    if not is_new and is_thumbnail_valid(thumb_path, deep):
+        return task, 'valid'
+    if not source_exists:
+        return task, 'missing_source'
+    return task, 'created' if create_thumbnail(full_path, thumb_path) else 'failed'
+
+
+def fix_thumbnails(conn, deep=False):
+    """一次扫描中补全thumbnail_filename为NULL的记录，并检查修复缺失或损坏的缩略图文件
+
+    deep为True时用verify()完整校验每个缩略图。
+    """
+    records = get_thumbnail_records(conn)
+    print(f"开始检查 {len(records)} 条记录的缩略图...")
     
-    if not null_records:
-        print("没有发现thumbnail_filename为NULL的记录。")
-        return fixed_count
+    # 按目录批量检查原文件是否存在
+    existing_files = utils.find_existing_files([record['file_path'] for record in records])
     
-    print(f"发现 {len(null_records)} 条记录的thumbnail_filename为NULL，开始修复...")
+    # 一次性算出所有缩略图文件名和路径（thumbnail_filename为NULL时使用 <id>.jpg）
+    thumbnail_filenames = [record['thumbnail_filename'] or f"{record['id']:06d}.jpg" for record in records]
+    thumb_paths = [os.path.join(THUMBNAIL_DIR, name) for name in thumbnail_filenames]
     
-    cursor = conn.cursor()
-    for record in null_records:
-        artwork_id = record['id']
+    # 逐条结果只计数，结束后统一输出；生成失败的缩略图单独提示
+    stats = Counter()
+    tasks = []
+    for record, thumbnail_filename, thumb_path in zip(records, thumbnail_filenames, thumb_paths):
         file_path = record['file_path']
-        
-        print(f"  处理 ID {artwork_id}: {file_path}")
-        
-        # 检查原文件是否存在
-        if not os.path.exists(file_path):
-            print(f"    [跳过] 原文件不存在: {file_path}")
+        source_exists = file_path in existing_files
+        is_new = record['thumbnail_filename'] is None
+        # thumbnail_filename为NULL：原文件存在时生成缩略图并补全文件名
+        if is_new and not source_exists:
+            stats['原文件不存在，已跳过'] += 1
             continue
-        
-        # 生成缩略图文件名
-        thumbnail_filename = f"{artwork_id:06d}.jpg"
-        
-        # 创建缩略图
-        if create_thumbnail(file_path, thumbnail_filename):
-            # 更新数据库记录
-            cursor.execute(
-                "UPDATE artworks SET thumbnail_filename = ? WHERE id = ?",
-                (thumbnail_filename, artwork_id)
-            )
-            print(f"    [成功] 已为ID {artwork_id} 创建缩略图 {thumbnail_filename}")
-            fixed_count += 1
-        else:
-            print(f"    [失败] 无法为ID {artwork_id} 创建缩略图")
+        tasks.append((record['id'], file_path, thumbnail_filename, thumb_path, is_new, source_exists))
     
-    conn.commit()
-    print(f"修复完成，共修复了 {fixed_count} 条记录。\n")
-    return fixed_count
-
-
-def check_and_fix_missing_or_corrupted_thumbnails(conn):
-    """检查并修复缺失或损坏的缩略图文件"""
-    all_records = get_all_artwork_records(conn)
+    # 检查和重新生成都在同一个进程池中完成，数据库只在主进程中更新
+    updates = []
     fixed_count = 0
+    if tasks:
+        with create_image_pool(initializer=init_thumbnail_worker, initargs=(THUMBNAIL_DIR,)) as executor:
+            results = executor.map(partial(fix_thumbnail_worker, deep=deep), tasks, chunksize=WORKER_CHUNKSIZE)
+            for (artwork_id, _, thumbnail_filename, _, is_new, _), status in tqdm(
+                    results, total=len(tasks), desc="检查缩略图", unit="张", mininterval=0.2):
+                if status == 'valid':
+                    stats['缩略图有效'] += 1
+                    continue
+                if not is_new:
+                    stats['发现缺失或损坏的缩略图'] += 1
+                if status == 'missing_source':
+                    stats['原文件不存在，已跳过'] += 1
+                elif status == 'created':
+                    if is_new:
+                        updates.append((thumbnail_filename, artwork_id))
+                    stats['已创建缩略图'] += 1
+                    fixed_count += 1
+                else:
+                    stats['创建失败'] += 1
+                    tqdm.write(f"  [失败] 无法为ID {artwork_id} 创建缩略图 {thumbnail_filename}")
     
-    print("开始检查所有缩略图文件是否存在或损坏...")
+    for label, n in stats.items():
+        print(f"  {label}: {n}")
     
-    for record in all_records:
-        artwork_id = record['id']
-        file_path = record['file_path']
-        thumbnail_filename = record['thumbnail_filename']
-        
-        # 跳过thumbnail_filename为NULL的记录
-        if not thumbnail_filename:
-            continue
-        
-        thumb_path = os.path.join(THUMBNAIL_DIR, thumbnail_filename)
-        
-        # 检查缩略图是否存在且有效
-        if not is_thumbnail_valid(thumb_path):
-            print(f"  发现缺失或损坏的缩略图: {thumbnail_filename} (ID: {artwork_id})")
-            
-            # 检查原文件是否存在
-            if not os.path.exists(file_path):
-                print(f"    [跳过] 原文件不存在: {file_path}")
-                continue
-            
-            # 重新创建缩略图
-            if create_thumbnail(file_path, thumbnail_filename):
-                print(f"    [成功] 重新创建缩略图 {thumbnail_filename}")
-                fixed_count += 1
-            else:
-                print(f"    [失败] 无法重新创建缩略图 {thumbnail_filename}")
-    
-    print(f"检查完成，共修复了 {fixed_count} 个缺失或损坏的缩略图。\n")
+    conn.executemany("UPDATE artworks SET thumbnail_filename = ? WHERE id = ?", updates)
+    conn.commit()
+    print(f"检查完成，共修复了 {fixed_count} 个缩略图（其中 {len(updates)} 条记录补全了thumbnail_filename）。\n")
     return fixed_count
 
 
@@ -155,6 +180,9 @@ def main():
     """主函数"""
     print("=== 缩略图检查和修复工具 ===\n")
     
+    # --deep: 用verify()完整校验缩略图（较慢），默认只检查文件头和结束标记
+    deep = '--deep' in sys.argv
+    
     # 确保缩略图目录存在
     if not os.path.exists(THUMBNAIL_DIR):
         os.makedirs(THUMBNAIL_DIR)
@@ -163,11 +191,8 @@ def main():
     # 建立数据库连接
     conn = setup_database_connection()
     
-    # 修复thumbnail_filename为NULL的记录
-    fix_null_thumbnails(conn)
-    
-    # 检查并修复缺失或损坏的缩略图
-    check_and_fix_missing_or_corrupted_thumbnails(conn)
+    # 补全缺少的缩略图，并检查修复缺失或损坏的缩略图
+    fix_thumbnails(conn, deep=deep)
     
     # 关闭数据库连接
     conn.close()
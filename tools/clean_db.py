@@ -1,8 +1,10 @@
 import os
 import sqlite3
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from PIL import Image
+from tqdm import tqdm
 
 # 禁用 PIL 的解压炸弹保护（允许处理大图片）
 Image.MAX_IMAGE_PIXELS = None
@@ -14,10 +16,32 @@ sys.path.insert(0, str(PROJECT_ROOT))
 os.chdir(PROJECT_ROOT)  # 切换工作目录到项目根目录
 
 import config # 导入你的配置文件以获取数据库名
+import utils
+from db_utils import open_db, delete_artworks
 
-def check_and_clean_paths():
+# 检查图片是否损坏时的并发线程数（主要耗时在磁盘读取，多线程可以重叠I/O等待）
+PROBE_WORKERS = 32
+
+def probe_image(file_path, deep=False):
+    """
+    检查图片是否损坏，返回损坏原因，图片正常时返回None。
+    deep为True时用 img.verify() 完整校验，否则只检查文件头和结束标记。
+    """
+    if not deep:
+        if utils.is_image_file_complete(file_path):
+            return None
+        return "图片损坏: 文件头或结束标记无效"
+    try:
+        with Image.open(file_path) as img:
+            img.verify()  # 验证图片完整性
+    except Exception as e:
+        return f"图片损坏: {str(e)}"
+    return None
+
+def check_and_clean_paths(deep=False):
     """
     检查数据库中所有文件路径的有效性，并根据用户确认删除无效记录。
+    deep为True时用 img.verify() 完整校验图片，否则只检查文件头和结束标记。
     """
     db_file = config.DB_FILE
     if not os.path.exists(db_file):
@@ -26,7 +50,7 @@ def check_and_clean_paths():
 
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = open_db(db_file)
         # 让返回的行可以像字典一样访问，提高代码可读性
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
@@ -40,26 +64,32 @@ def check_and_clean_paths():
         invalid_records = []
         corrupted_records = []
         
+        # 按目录批量检查文件是否存在
+        existing_files = utils.find_existing_files([record['file_path'] for record in all_records])
+        
+        existing_records = []
         for record in all_records:
-            file_path = record['file_path']
-            
             # 检查文件是否存在
-            if not os.path.exists(file_path):
+            if record['file_path'] not in existing_files:
                 invalid_records.append({
                     "id": record['id'],
-                    "path": file_path,
+                    "path": record['file_path'],
                     "reason": "文件不存在"
                 })
             else:
-                # 文件存在，检查是否损坏
-                try:
-                    with Image.open(file_path) as img:
-                        img.verify()  # 验证图片完整性
-                except Exception as e:
+                existing_records.append(record)
+        
+        # 文件存在，多线程并发检查是否损坏
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+            reasons = executor.map(lambda path: probe_image(path, deep),
+                                   [record['file_path'] for record in existing_records])
+            for record, reason in tqdm(zip(existing_records, reasons), total=len(existing_records),
+                                       desc="检查文件", unit="张", mininterval=0.2):
+                if reason is not None:
                     corrupted_records.append({
                         "id": record['id'],
-                        "path": file_path,
-                        "reason": f"图片损坏: {str(e)}"
+                        "path": record['file_path'],
+                        "reason": reason
                     })
         
         # 合并无效记录和损坏记录
@@ -96,12 +126,8 @@ def check_and_clean_paths():
             # --- 执行删除 ---
             ids_to_delete = [rec['id'] for rec in all_invalid]
             
-            # 使用 'IN' 子句和参数化查询，一次性删除所有记录，高效且安全
-            placeholders = ','.join(['?'] * len(ids_to_delete))
-            sql_query = f"DELETE FROM artworks WHERE id IN ({placeholders})"
-            
-            cursor.execute(sql_query, ids_to_delete)
-            conn.commit()
+            # 通过临时表一次性删除所有记录，记录再多也不会超出参数个数上限
+            delete_artworks(conn, ids_to_delete)
             
             print(f"\n操作成功！已从数据库中删除了 {len(ids_to_delete)} 条问题记录。")
             
@@ -132,4 +158,5 @@ def check_and_clean_paths():
 
 if __name__ == "__main__":
     print("--- 数据库无效路径清理工具 ---")
-    check_and_clean_paths()
\ No newline at end of file
+    # --deep: 用 img.verify() 完整校验每张图片（较慢）
+    check_and_clean_paths(deep='--deep' in sys.argv)
\ No newline at end of file
@@ -0,0 +1,43 @@
+"""
+管理脚本共用的数据库连接
+"""
+
+import sqlite3
+
+# 内存映射读取的上限和页缓存大小（负数表示KiB）
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 64 * 1024
+
+
+def open_db(path):
+    """打开SQLite数据库，设置适合批量读写的PRAGMA
+
+    管理脚本都是单写入者：WAL + synchronous=NORMAL 下提交不再每次fsync，
+    读取通过mmap进行，临时表放在内存中。
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+    return conn
+
+
+def delete_artworks(conn, artwork_ids):
+    """按id批量删除artworks中的记录并提交，返回删除的行数
+
+    id先写入临时表，再用子查询一次删除：不受SQLite单条语句参数个数的上限限制。
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS _to_del(id INTEGER PRIMARY KEY)")
+        conn.executemany("INSERT OR IGNORE INTO _to_del VALUES (?)", ((i,) for i in artwork_ids))
+        deleted = conn.execute("DELETE FROM artworks WHERE id IN (SELECT id FROM _to_del)").rowcount
+        conn.execute("DROP TABLE _to_del")
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return deleted
@@ -4,7 +4,9 @@ import sqlite3
 import sys
 import shutil
 import datetime
+from collections import Counter
 from pathlib import Path
+from tqdm import tqdm
 
 # 添加项目根目录到Python路径
 SCRIPT_DIR = Path(__file__).parent
@@ -12,6 +14,9 @@ PROJECT_ROOT = SCRIPT_DIR.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 os.chdir(PROJECT_ROOT)  # 切换工作目录到项目根目录
 
+import utils
+from db_utils import open_db, delete_artworks
+
 # --- 配置区 ---
 # 确认数据库文件名正确
 DB_FILE = "zootopia_gallery.db"
@@ -25,6 +30,45 @@ THUMBNAIL_DIR = os.path.join('static', 'thumbnails')
 # 垃圾箱目录（将被移动到这里，而不是删除）
 TRASH_DIR = os.path.join('.', 'trash')
 
+def move_to_trash(src, trash_dir, name, suffix):
+    """
+    把文件移动到垃圾箱目录下的 name，目标已存在时改用 name_<suffix> 等不重复的文件名。
+    同一文件系统下用硬链接+删除原文件完成移动（不复制数据，且不会覆盖已有文件），
+    不支持硬链接或跨文件系统时回退到 shutil.move。返回最终的目标路径。
+    """
+    stem, ext = os.path.splitext(name)
+    target = os.path.join(trash_dir, name)
+    attempt = 0
+    while True:
+        try:
+            os.link(src, target)
+            break
+        except FileExistsError:
+            attempt += 1
+            unique_name = f"{stem}_{suffix}{ext}" if attempt == 1 else f"{stem}_{suffix}_{attempt}{ext}"
+            target = os.path.join(trash_dir, unique_name)
+        except OSError:
+            # 跨文件系统或文件系统不支持硬链接
+            if os.path.exists(target):
+                target = os.path.join(trash_dir, f"{stem}_{suffix}{ext}")
+            shutil.move(src, target)
+            return target
+    os.unlink(src)
+    return target
+
+def fsync_dir(path):
+    """同步目录项到磁盘（Windows 不支持打开目录，直接跳过）"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def cleanup_images():
     """
     执行查找、统计、确认并删除指定评级的图片和数据库记录的流程。
@@ -39,8 +83,13 @@ def cleanup_images():
     conn = None
     try:
         # 2. 连接数据库并查询目标记录
-        conn = sqlite3.connect(DB_FILE)
+        conn = open_db(DB_FILE)
         conn.row_factory = sqlite3.Row # 让我们能通过列名访问数据
+        # 按评级查找时使用索引，不扫描整张表（未评级的行不进入索引）
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_artworks_rating
+            ON artworks(rating) WHERE rating IS NOT NULL
+        """)
         cursor = conn.cursor()
         print(f"已连接到数据库 '{DB_FILE}'。")
 
@@ -81,51 +130,61 @@ def cleanup_images():
             # 继续执行，但移动操作可能失败
             trash_thumbs_dir = os.path.join(TRASH_DIR, 'thumbnails')
 
-        for row in records_to_delete:
+        # 循环内频繁调用的函数先绑定到局部变量
+        join = os.path.join
+        basename = os.path.basename
+
+        # 按目录批量检查原图和缩略图是否存在
+        existing_files = utils.find_existing_files(
+            [row['file_path'] for row in records_to_delete] +
+            [join(THUMBNAIL_DIR, row['thumbnail_filename'])
+             for row in records_to_delete if row['thumbnail_filename']]
+        )
+
+        # 文件名冲突时使用的后缀，整次清理共用一个时间戳
+        trash_suffix = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+
+        # 逐条结果只计数，结束后统一输出；移动失败的文件单独提示
+        stats = Counter()
+        for row in tqdm(records_to_delete, desc="移至垃圾箱", unit="张", mininterval=0.2):
             artwork_id = row['id']
             original_path = row['file_path']
             thumbnail_filename = row['thumbnail_filename']
 
             # a. 移动原图文件到垃圾箱
-            if original_path and os.path.exists(original_path):
+            if original_path and original_path in existing_files:
                 try:
-                    base = os.path.basename(original_path)
-                    target = os.path.join(TRASH_DIR, base)
-                    if os.path.exists(target):
-                        ts = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
-                        name, ext = os.path.splitext(base)
-                        target = os.path.join(TRASH_DIR, f"{name}_{ts}{ext}")
-                    shutil.move(original_path, target)
-                    print(f"  - [文件已移至垃圾箱] ID {artwork_id:06d}: {target}")
+                    move_to_trash(original_path, TRASH_DIR, basename(original_path), trash_suffix)
+                    stats['文件已移至垃圾箱'] += 1
                     deleted_files_count += 1
                 except OSError as e:
-                    print(f"  - [文件移动失败] ID {artwork_id:06d}: {e}")
+                    stats['文件移动失败'] += 1
+                    tqdm.write(f"  - [文件移动失败] ID {artwork_id:06d}: {e}")
             else:
-                print(f"  - [文件未找到] ID {artwork_id:06d}: {original_path} (已跳过)")
+                stats['文件未找到'] += 1
 
             # b. 移动缩略图文件到垃圾箱缩略图子目录
             if thumbnail_filename:
-                thumb_path = os.path.join(THUMBNAIL_DIR, thumbnail_filename)
-                if os.path.exists(thumb_path):
+                thumb_path = join(THUMBNAIL_DIR, thumbnail_filename)
+                if thumb_path in existing_files:
                     try:
-                        target_thumb = os.path.join(trash_thumbs_dir, thumbnail_filename)
-                        if os.path.exists(target_thumb):
-                            ts = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
-                            name, ext = os.path.splitext(thumbnail_filename)
-                            target_thumb = os.path.join(trash_thumbs_dir, f"{name}_{ts}{ext}")
-                        shutil.move(thumb_path, target_thumb)
-                        print(f"  - [缩略图已移至垃圾箱] ID {artwork_id:06d}: {target_thumb}")
+                        move_to_trash(thumb_path, trash_thumbs_dir, thumbnail_filename, trash_suffix)
+                        stats['缩略图已移至垃圾箱'] += 1
                     except OSError as e:
-                        print(f"  - [缩略图移动失败] ID {artwork_id:06d}: {e}")
+                        stats['缩略图移动失败'] += 1
+                        tqdm.write(f"  - [缩略图移动失败] ID {artwork_id:06d}: {e}")
                 else:
-                    print(f"  - [缩略图未找到] ID {artwork_id:06d}: {thumb_path} (已跳过)")
-            
-            # c. 从数据库中删除记录 (暂不提交)
-            cursor.execute("DELETE FROM artworks WHERE id = ?", (artwork_id,))
-            deleted_records_count += 1
-
-        # 5. 提交所有数据库更改
-        conn.commit()
+                    stats['缩略图未找到'] += 1
+
+        for label, n in stats.items():
+            print(f"  - {label}: {n}")
+
+        # 所有文件移动完成后统一同步一次垃圾箱目录
+        fsync_dir(TRASH_DIR)
+        fsync_dir(trash_thumbs_dir)
+
+        # 5. 通过临时表一次性删除所有数据库记录并提交
+        deleted_records_count = delete_artworks(conn, [row['id'] for row in records_to_delete])
         print("\n所有数据库记录删除操作已提交。")
 
     except sqlite3.Error as e:
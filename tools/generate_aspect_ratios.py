@@ -8,18 +8,29 @@ import sqlite3
 import os
 import sys
 from PIL import Image
+from tqdm import tqdm
+
+# imagesize 只解析文件头获取尺寸，未安装时回退到 PIL
+try:
+    import imagesize
+except ImportError:
+    imagesize = None
 
-Image.MAX_IMAGE_PIXELS = None
 # 添加父目录到路径以便导入config
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
+import utils
+from db_utils import open_db
+from worker_utils import create_image_pool
 
 ASPECT_RATIO_DB = "aspect_ratios.db"
 MAIN_DB = config.DB_FILE
+WORKER_CHUNKSIZE = 256
+INSERT_BATCH_SIZE = 1000
 
 def create_aspect_ratio_db():
     """创建宽高比数据库"""
-    conn = sqlite3.connect(ASPECT_RATIO_DB)
+    conn = open_db(ASPECT_RATIO_DB)
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -37,87 +48,100 @@ def create_aspect_ratio_db():
     print(f"✓ 宽高比数据库已创建: {ASPECT_RATIO_DB}")
 
 def get_image_aspect_ratio(file_path):
-    """获取图片的宽高比"""
+    """获取图片的宽高比（只读取文件头，不解码图片）"""
     try:
-        with Image.open(file_path) as img:
-            width, height = img.size
-            if height > 0:
-                aspect_ratio = width / height
-                return aspect_ratio, width, height
+        if imagesize is not None:
+            width, height = imagesize.get(file_path)
+        else:
+            width = height = -1
+        if width <= 0 or height <= 0:
+            # imagesize 不支持的格式交给 PIL，Image.open 本身也只解析文件头
+            with Image.open(file_path) as img:
+                width, height = img.size
+        if height > 0:
+            aspect_ratio = width / height
+            return aspect_ratio, width, height
     except Exception as e:
         print(f"  ✗ 无法读取图片: {file_path} - {e}")
     return None, None, None
 
+def aspect_ratio_worker(task):
+    """进程池任务：返回 (artwork_id, aspect_ratio, width, height)"""
+    artwork_id, file_path = task
+    return (artwork_id, *get_image_aspect_ratio(file_path))
+
 def generate_aspect_ratios(force_update=False):
     """生成所有图片的宽高比数据"""
-    # 连接主数据库
-    main_conn = sqlite3.connect(MAIN_DB)
-    main_conn.row_factory = sqlite3.Row
-    main_cursor = main_conn.cursor()
-    
-    # 连接宽高比数据库
-    ar_conn = sqlite3.connect(ASPECT_RATIO_DB)
-    ar_cursor = ar_conn.cursor()
-    
-    # 获取所有图片
-    main_cursor.execute("SELECT id, file_path FROM artworks")
-    artworks = main_cursor.fetchall()
-    
-    total = len(artworks)
-    processed = 0
-    skipped = 0
+    # 连接主数据库，并把宽高比数据库附加到同一连接上，读写在同一个事务里完成
+    conn = open_db(MAIN_DB)
+    conn.row_factory = sqlite3.Row
+    conn.execute("ATTACH DATABASE ? AS ar", (ASPECT_RATIO_DB,))
+    cursor = conn.cursor()
+    
+    total = cursor.execute("SELECT COUNT(*) FROM artworks").fetchone()[0]
+    
+    # 获取需要处理的图片（非强制模式下用反连接在SQL中排除已有记录）
+    if force_update:
+        artworks = cursor.execute("SELECT id, file_path FROM artworks").fetchall()
+    else:
+        artworks = cursor.execute("""
+            SELECT a.id, a.file_path FROM artworks a
+            LEFT JOIN ar.aspect_ratios x ON x.artwork_id = a.id
+            WHERE x.artwork_id IS NULL
+        """).fetchall()
+    
+    skipped = total - len(artworks)
     updated = 0
     errors = 0
+    missing = 0
     
-    print(f"\n开始处理 {total} 张图片...")
+    print(f"\n开始处理 {len(artworks)} 张图片（跳过 {skipped} 张已有记录）...")
     
+    # 按目录批量检查文件是否存在
+    existing_files = utils.find_existing_files([artwork['file_path'] for artwork in artworks])
+    tasks = []
     for artwork in artworks:
-        artwork_id = artwork['id']
-        file_path = artwork['file_path']
-        
-        # 检查是否已存在
-        if not force_update:
-            ar_cursor.execute("SELECT artwork_id FROM aspect_ratios WHERE artwork_id = ?", (artwork_id,))
-            if ar_cursor.fetchone():
-                skipped += 1
-                continue
-        
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
-            print(f"  ✗ 文件不存在: {file_path}")
-            errors += 1
-            continue
-        
-        # 获取宽高比
-        aspect_ratio, width, height = get_image_aspect_ratio(file_path)
-        
-        if aspect_ratio is not None:
-            # 插入或更新数据库
-            ar_cursor.execute("""
-                INSERT OR REPLACE INTO aspect_ratios (artwork_id, aspect_ratio, width, height, updated_at)
-                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-            """, (artwork_id, aspect_ratio, width, height))
-            
-            updated += 1
-            processed += 1
-            
-            if processed % 100 == 0:
-                print(f"  进度: {processed}/{total} ({processed*100//total}%)")
-                ar_conn.commit()
+        if artwork['file_path'] in existing_files:
+            tasks.append((artwork['id'], artwork['file_path']))
         else:
-            errors += 1
-    
-    # 提交最后的更改
-    ar_conn.commit()
+            missing += 1
+    
+    pending = []
+    with create_image_pool() as executor:
+        results = executor.map(aspect_ratio_worker, tasks, chunksize=WORKER_CHUNKSIZE)
+        for artwork_id, aspect_ratio, width, height in tqdm(results, total=len(tasks), desc="读取宽高比",
+                                                             unit="张", mininterval=0.2):
+            if aspect_ratio is not None:
+                pending.append((artwork_id, aspect_ratio, width, height))
+                updated += 1
+            else:
+                errors += 1
+            
+            if len(pending) >= INSERT_BATCH_SIZE:
+                cursor.executemany("""
+                    INSERT OR REPLACE INTO ar.aspect_ratios (artwork_id, aspect_ratio, width, height, updated_at)
+                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                """, pending)
+                # 每批提交一次，中断或出错时已完成的批次不会丢失
+                conn.commit()
+                pending.clear()
+    
+    # 写入剩余记录并提交
+    if pending:
+        cursor.executemany("""
+            INSERT OR REPLACE INTO ar.aspect_ratios (artwork_id, aspect_ratio, width, height, updated_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        """, pending)
+    conn.commit()
     
     # 关闭连接
-    main_conn.close()
-    ar_conn.close()
+    conn.close()
     
     print(f"\n完成!")
     print(f"  总计: {total}")
     print(f"  已更新: {updated}")
     print(f"  已跳过: {skipped}")
+    print(f"  文件不存在: {missing}")
     print(f"  错误: {errors}")
 
 def show_stats():
@@ -126,7 +150,7 @@ def show_stats():
         print("宽高比数据库不存在")
         return
     
-    conn = sqlite3.connect(ASPECT_RATIO_DB)
+    conn = open_db(ASPECT_RATIO_DB)
     cursor = conn.cursor()
     
     cursor.execute("SELECT COUNT(*) FROM aspect_ratios")
@@ -10,37 +10,72 @@ PROJECT_ROOT = SCRIPT_DIR.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 os.chdir(PROJECT_ROOT)  # 切换工作目录到项目根目录
 
+from worker_utils import create_image_pool
 from PIL import Image
+from tqdm import tqdm
 import imagehash
 import config
+import utils
+from db_utils import open_db
 
+# 每生成多少条哈希批量写入并提交一次
+HASH_BATCH_SIZE = 1000
+# 每次分发给进程的任务数
+WORKER_CHUNKSIZE = 64
 
-def normalize_path(p):
+
+def alternate_path(p):
+    """替换 '/' 和 '\\' 为系统分隔符后的路径"""
+    return p.replace('/', os.sep).replace('\\', os.sep)
+
+
+def normalize_path(p, existing_files=None):
     # 尝试直接使用原路径；如果不存在，则替换 '/' 为系统分隔符后重试
-    if os.path.exists(p):
+    # existing_files 为预先批量检查得到的存在路径集合，提供时不再逐个stat
+    exists = (lambda path: path in existing_files) if existing_files is not None else os.path.exists
+    if exists(p):
         return p
-    alt = p.replace('/', os.sep).replace('\\', os.sep)
-    if os.path.exists(alt):
+    alt = alternate_path(p)
+    if exists(alt):
         return alt
     # 仍然不存在，返回原路径（后续将跳过）
     return p
 
 
-def backfill_hashes(commit_each=True, limit=None):
+def phash_worker(task):
+    """进程池任务：返回 (artwork_id, phash字符串, 错误信息)"""
+    artwork_id, file_path = task
+    try:
+        with Image.open(file_path) as img:
+            return artwork_id, str(imagehash.phash(img)), None
+    except Exception as e:
+        return artwork_id, None, str(e)
+
+
+def backfill_hashes(limit=None):
     """为数据库中所有缺少phash的图片生成并填充感知哈希值。
 
+    哈希在进程池中并行计算，每HASH_BATCH_SIZE条批量写入并提交一次；
+    中断后重新运行会从 phash IS NULL 的记录继续。
+
     参数:
-      commit_each: 是否在处理每条记录后立即提交（True -> 实时写入）
       limit: 可选，最多处理的记录数
     """
-    print("--- 开始为现有图片生成感知哈希 (实时写入模式) ---")
+    print("--- 开始为现有图片生成感知哈希 ---")
     conn = None
     try:
-        conn = sqlite3.connect(config.DB_FILE)
+        conn = open_db(config.DB_FILE)
         conn.row_factory = sqlite3.Row
+        # 缺少phash的记录很少，部分索引只包含这些行，查询不必扫描整张表
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_artworks_phash_null
+            ON artworks(id) WHERE phash IS NULL
+        """)
         cursor = conn.cursor()
 
-        cursor.execute("SELECT id, file_path FROM artworks WHERE phash IS NULL")
+        # 在SQL中限制数量，不读取用不到的行（LIMIT -1 表示不限制）
+        cursor.execute("SELECT id, file_path FROM artworks WHERE phash IS NULL LIMIT ?",
+                       (-1 if limit is None else limit,))
         records_to_process = cursor.fetchall()
 
         if not records_to_process:
@@ -48,43 +83,46 @@ def backfill_hashes(commit_each=True, limit=None):
             return
 
         total = len(records_to_process)
-        if limit is not None:
-            records_to_process = records_to_process[:limit]
-            total = len(records_to_process)
 
         print(f"发现 {total} 张图片需要生成哈希...")
-        processed_count = 0
+        # 按目录批量检查原路径和替换分隔符后的路径是否存在
+        candidate_paths = [row['file_path'] for row in records_to_process]
+        existing_files = utils.find_existing_files(candidate_paths + [alternate_path(p) for p in candidate_paths])
+        tasks = []
         for row in records_to_process:
-            artwork_id = row['id']
-            file_path = row['file_path']
-
-            processed_count += 1
-            status_msg = f"处理中 ({processed_count}/{total}): ID {artwork_id:06d}"
-            print(status_msg, end='\r', flush=True)
-
-            norm_path = normalize_path(file_path)
-            if not os.path.exists(norm_path):
-                print(f"\n[警告] 文件未找到，已跳过: {file_path}")
-                continue
-
-            try:
-                with Image.open(norm_path) as img:
-                    hash_value = imagehash.phash(img)
-                cursor.execute("UPDATE artworks SET phash = ? WHERE id = ?", (str(hash_value), artwork_id))
-                if commit_each:
-                    conn.commit()
-            except KeyboardInterrupt:
-                print('\n[中断] 用户终止，正在退出。')
-                break
-            except Exception as e:
-                print(f"\n[错误] 处理文件 {file_path} 失败: {e}")
-                continue
-
-        # 如果选择不每次提交，则在最后统一提交
-        if not commit_each:
-            conn.commit()
-
-        print("\n\n所有处理已完成（已写入数据库）。")
+            norm_path = normalize_path(row['file_path'], existing_files)
+            if norm_path in existing_files:
+                tasks.append((row['id'], norm_path))
+        missing_count = total - len(tasks)
+        error_count = 0
+
+        pending_updates = []  # 尚未写入的 (phash, id)
+        executor = create_image_pool()
+        try:
+            results = executor.map(phash_worker, tasks, chunksize=WORKER_CHUNKSIZE)
+            with tqdm(total=len(tasks), desc="生成哈希", unit="张", mininterval=0.2) as pbar:
+                for artwork_id, hash_value, error in results:
+                    pbar.update(1)
+                    if error is not None:
+                        error_count += 1
+                        tqdm.write(f"[错误] 处理 ID {artwork_id} 失败: {error}")
+                        continue
+                    pending_updates.append((hash_value, artwork_id))
+                    if len(pending_updates) >= HASH_BATCH_SIZE:
+                        cursor.executemany("UPDATE artworks SET phash = ? WHERE id = ?", pending_updates)
+                        conn.commit()
+                        pending_updates = []
+        except KeyboardInterrupt:
+            print('\n[中断] 用户终止，正在退出。')
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # 写入剩余的记录（包括用户中断前已生成的哈希）并提交
+        cursor.executemany("UPDATE artworks SET phash = ? WHERE id = ?", pending_updates)
+        conn.commit()
+
+        print(f"\n文件未找到: {missing_count}，处理失败: {error_count}")
+        print("所有处理已完成（已写入数据库）。")
 
     except sqlite3.Error as e:
         print(f"\n数据库操作发生错误: {e}")
@@ -95,12 +133,13 @@ def backfill_hashes(commit_each=True, limit=None):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Backfill perceptual hashes (phash) for artworks')
-    parser.add_argument('--no-commit-each', action='store_true', help='不要在每条记录后提交（默认会实时提交）')
     parser.add_argument('--limit', type=int, default=None, help='最多处理的记录数（可选）')
+    # 兼容旧的调用方式：现在总是每HASH_BATCH_SIZE条提交一次，该参数不再有作用
+    parser.add_argument('--no-commit-each', action='store_true', help=f'已废弃，保留以兼容旧命令（现在总是每{HASH_BATCH_SIZE}条提交一次）')
     args = parser.parse_args()
 
     try:
-        backfill_hashes(commit_each=not args.no_commit_each, limit=args.limit)
+        backfill_hashes(limit=args.limit)
     except Exception as exc:
         print(f"运行时发生错误: {exc}")
         sys.exit(1)
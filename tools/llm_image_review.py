@@ -7,29 +7,66 @@ LLM图片审核工具
 
 import sys
 import os
+import re
+import argparse
 import sqlite3
 import base64
+import hashlib
+import time
 import json
-import requests
+import urllib3
 import io
 import signal
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import PIL
 from PIL import Image
 from datetime import datetime
 from tqdm import tqdm
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # 可选依赖，未安装时使用标准库json
+
+# PyTurboJPEG 直接调用 libjpeg-turbo 编码JPEG，未安装或找不到动态库时使用 Pillow 编码
+try:
+    import numpy as np
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None
+
+# 安装了 OpenCV 时用它完成解码、缩放和JPEG编码（SIMD加速，中间不转换为PIL图像），否则使用 Pillow
+try:
+    import cv2
+    import numpy as np
+    OPENCV_REDUCED_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+except ImportError:
+    cv2 = None
+
 # 添加项目根目录到路径
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
+import utils
+from db_utils import open_db
 
 # 全局标志：用于优雅退出
 shutdown_flag = threading.Event()
 
+# 与LMstudio的连接池，各工作线程共享并保持连接（连接按需建立，超过maxsize的连接用完即关闭）
+http_pool = urllib3.PoolManager(num_pools=1, maxsize=32)
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
 # LLM配置
 LM_STUDIO_BASE_URL = "http://127.0.0.1:1234/v1"
 LM_STUDIO_MODEL = "local-model"
 
+# 审核图片的缩放滤镜（安装 Pillow-SIMD 后 LANCZOS/BICUBIC 等滤镜会自动使用SIMD加速）
+REVIEW_RESAMPLE_FILTER = Image.Resampling[config.REVIEW_RESAMPLE_FILTER.upper()]
+
 # 审核提示词
 REVIEW_SYSTEM_PROMPT = """You are an expert content moderator reviewing images.
 Analyze the image and determine if it meets content guidelines.
@@ -45,49 +82,257 @@ Guidelines:
 - FAIL: Image contains inappropriate content, misclassified, or violates guidelines
 """
 
+# 匹配响应中的决策行（允许 "Decision: [PASS]" 这样带括号的写法）
+DECISION_RE = re.compile(r'^\s*Decision:\s*\[?\s*(PASS|FAIL)', re.IGNORECASE | re.MULTILINE)
+
+# 审核结果缓存：按图片pHash和提示词记录决策，内容相同的图片和重复运行时不再请求LLM
+REVIEW_CACHE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "review_cache.db")
+REVIEW_CACHE_MAX_ENTRIES = 200_000  # 超出后按最近使用时间淘汰
+REVIEW_PROMPT_HASH = hashlib.sha1(f"{LM_STUDIO_MODEL}\n{REVIEW_SYSTEM_PROMPT}".encode('utf-8')).hexdigest()
+cache_lock = threading.Lock()
+
+# 从数据库分批读取待审核图片的行数
+FETCH_BATCH_SIZE = 1000
+
+# 不通过的图片ID先缓存在内存中，攒够一定数量或超过一定时间再写入文件
+FAILED_IDS_FLUSH_COUNT = 64
+FAILED_IDS_FLUSH_INTERVAL = 5.0  # 秒
+
+# 批量审核时附加的说明：一次请求包含多张图片，每张图片输出一行决策
+REVIEW_BATCH_INSTRUCTION = """
+You will receive {count} images. Review each image independently.
+Respond with exactly one Decision line per image, in the same order as the images:
+Decision: [PASS/FAIL]
+"""
+
+# 请求中不变的部分只在导入时构建一次，每次请求只新建图片内容块；
+# 提示词文本块在所有请求中完全相同，LMstudio可以复用其前缀缓存
+REVIEW_REQUEST_BASE = {"model": LM_STUDIO_MODEL, "max_tokens": 100, "temperature": 0.1, "stream": False}
+REVIEW_PROMPT_BLOCK = {"type": "text", "text": REVIEW_SYSTEM_PROMPT}
+
+
+def open_resized(image_path, max_size, use_draft=True):
+    """打开图片并缩放到最长边不超过max_size
+
+    use_draft为True时JPEG在解码阶段直接按1/2、1/4、1/8缩小（不小于目标尺寸），再用滤镜缩放。
+    """
+    with Image.open(image_path) as img:
+        # 获取原始尺寸
+        width, height = img.size
+        
+        # 如果图片已经足够小，直接使用
+        if max(width, height) <= max_size:
+            return img.copy()
+        
+        # 计算缩放比例
+        if width > height:
+            new_width = max_size
+            new_height = int(height * max_size / width)
+        else:
+            new_height = max_size
+            new_width = int(width * max_size / height)
+        
+        if use_draft and img.format == 'JPEG':
+            img.draft('RGB', (new_width, new_height))
+        
+        # 缩放图片
+        return img.resize((new_width, new_height), REVIEW_RESAMPLE_FILTER)
+
+
+def encode_jpeg(img, quality=85):
+    """把RGB图片编码为JPEG，返回bytes或指向编码结果的memoryview（不额外复制）"""
+    if turbo_jpeg is not None:
+        return turbo_jpeg.encode(np.asarray(img), quality=quality,
+                                 pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getbuffer()
+
+
+def encode_with_opencv(raw, max_size, jpeg_size=None):
+    """用OpenCV把图片文件内容缩放到最长边不超过max_size并编码为JPEG
+
+    jpeg_size 为JPEG原图尺寸时，解码阶段直接按1/2、1/4、1/8缩小（不小于目标尺寸，与Pillow的draft相同）。
+    透明图铺白底。OpenCV无法解码的图片（如GIF）或非8位图片返回None，由调用方改用Pillow。
+    """
+    flags = cv2.IMREAD_UNCHANGED
+    if jpeg_size is not None:
+        reduce = max(jpeg_size) // max_size
+        if reduce >= 2:
+            flags = OPENCV_REDUCED_FLAGS[min(8, 1 << (reduce.bit_length() - 1))]
+    img = cv2.imdecode(np.frombuffer(raw, np.uint8), flags)
+    if img is None or img.dtype != np.uint8:
+        return None
+    
+    height, width = img.shape[:2]
+    if max(width, height) > max_size:
+        if width > height:
+            new_size = (max_size, max(1, int(height * max_size / width)))
+        else:
+            new_size = (max(1, int(width * max_size / height)), max_size)
+        # INTER_AREA 是缩小图片时合适的插值方式
+        img = cv2.resize(img, new_size, interpolation=cv2.INTER_AREA)
+    
+    if img.ndim == 3 and img.shape[2] == 4:
+        alpha = img[:, :, 3:].astype(np.float32) / 255
+        img = (img[:, :, :3] * alpha + 255 * (1 - alpha)).astype(np.uint8)
+    
+    ok, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return buffer if ok else None
+
 
 def encode_image_to_base64(image_path, max_size=896):
     """将图片下采样并编码为base64"""
     try:
-        with Image.open(image_path) as img:
-            # 获取原始尺寸
-            width, height = img.size
-            
-            # 如果图片已经足够小，直接使用
-            if max(width, height) <= max_size:
-                resized_img = img.copy()
-            else:
-                # 计算缩放比例
-                if width > height:
-                    new_width = max_size
-                    new_height = int(height * max_size / width)
-                else:
-                    new_height = max_size
-                    new_width = int(width * max_size / height)
-                
-                # 缩放图片
-                resized_img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            # 转换为JPEG格式并编码
-            buffer = io.BytesIO()
-            
-            # 如果是RGBA模式，转换为RGB
-            if resized_img.mode == 'RGBA':
-                background = Image.new('RGB', resized_img.size, (255, 255, 255))
-                background.paste(resized_img, mask=resized_img.split()[-1])
-                resized_img = background
-            elif resized_img.mode != 'RGB':
-                resized_img = resized_img.convert('RGB')
-            
-            resized_img.save(buffer, format='JPEG', quality=85)
-            buffer.seek(0)
-            
-            return base64.b64encode(buffer.getvalue()).decode('utf-8')
+        # 已经不超过max_size的RGB/灰度JPEG（如缩略图）直接编码文件内容，不再解码、缩放和重新压缩；
+        # Image.open只解析文件头，不解码像素
+        with open(image_path, 'rb') as f:
+            raw = f.read()
+        jpeg_size = None
+        if raw[:3] == b'\xff\xd8\xff':
+            with Image.open(io.BytesIO(raw)) as img:
+                if max(img.size) <= max_size and img.mode in ('RGB', 'L'):
+                    return base64.b64encode(raw).decode('ascii')
+                jpeg_size = img.size
+        
+        if cv2 is not None:
+            jpeg_data = encode_with_opencv(raw, max_size, jpeg_size)
+            if jpeg_data is not None:
+                return base64.b64encode(jpeg_data).decode('ascii')
+        
+        try:
+            resized_img = open_resized(image_path, max_size)
+        except Exception:
+            # 个别JPEG在缩小解码时出错，回退为完整解码后再缩放
+            resized_img = open_resized(image_path, max_size, use_draft=False)
+        
+        # 如果是RGBA模式，转换为RGB
+        if resized_img.mode == 'RGBA':
+            background = Image.new('RGB', resized_img.size, (255, 255, 255))
+            background.paste(resized_img, mask=resized_img.split()[-1])
+            resized_img = background
+        elif resized_img.mode != 'RGB':
+            resized_img = resized_img.convert('RGB')
+        
+        # 转换为JPEG格式并编码
+        return base64.b64encode(encode_jpeg(resized_img, quality=85)).decode('ascii')
             
     except Exception as e:
         return None
 
 
+def open_review_cache():
+    """打开审核结果缓存数据库（多个线程共用一个连接，访问时需持有cache_lock）"""
+    cache = sqlite3.connect(REVIEW_CACHE_DB, check_same_thread=False, isolation_level=None)
+    cache.execute("PRAGMA journal_mode=WAL")
+    cache.execute("PRAGMA synchronous=OFF")  # 缓存丢失只会导致重新审核
+    cache.execute("""
+        CREATE TABLE IF NOT EXISTS review_cache (
+            phash TEXT NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            decision TEXT NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (phash, prompt_hash)
+        )
+    """)
+    cache.execute("CREATE INDEX IF NOT EXISTS idx_review_cache_last_used ON review_cache(last_used)")
+    return cache
+
+
+def get_cached_decision(cache, phash):
+    """查询缓存的决策，命中时刷新最近使用时间"""
+    with cache_lock:
+        row = cache.execute(
+            "SELECT decision FROM review_cache WHERE phash = ? AND prompt_hash = ?",
+            (phash, REVIEW_PROMPT_HASH)).fetchone()
+        if row:
+            cache.execute(
+                "UPDATE review_cache SET last_used = ? WHERE phash = ? AND prompt_hash = ?",
+                (time.time(), phash, REVIEW_PROMPT_HASH))
+    return row[0] if row else None
+
+
+def store_decisions(cache, entries):
+    """写入 (phash, decision) 列表"""
+    now = time.time()
+    with cache_lock:
+        cache.executemany(
+            "INSERT OR REPLACE INTO review_cache (phash, prompt_hash, decision, last_used) VALUES (?, ?, ?, ?)",
+            [(phash, REVIEW_PROMPT_HASH, decision, now) for phash, decision in entries])
+
+
+def evict_review_cache(cache):
+    """只保留最近使用的 REVIEW_CACHE_MAX_ENTRIES 条记录"""
+    with cache_lock:
+        cache.execute("""
+            DELETE FROM review_cache WHERE rowid IN (
+                SELECT rowid FROM review_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        """, (REVIEW_CACHE_MAX_ENTRIES,))
+
+
+def post_json(url, payload, timeout):
+    """POST JSON请求，返回 (HTTP状态码, 解析后的响应，状态码不是200时为None)
+
+    安装了orjson时用orjson序列化和解析（请求体中有几百KB的base64图片数据）。
+    不使用urllib3的自动重试，失败由调用方处理。
+    """
+    body = orjson.dumps(payload) if orjson is not None else json.dumps(payload).encode('utf-8')
+    response = http_pool.request('POST', url, body=body, headers=JSON_HEADERS,
+                                 timeout=timeout, retries=False)
+    if response.status != 200:
+        return response.status, None
+    return response.status, orjson.loads(response.data) if orjson is not None else json.loads(response.data)
+
+
+def parse_decisions(content):
+    """按顺序解析响应中所有 Decision: 行，返回 'PASS'/'FAIL' 列表"""
+    return [decision.upper() for decision in DECISION_RE.findall(content)]
+
+
+def image_block(image_data):
+    """构建请求中的图片内容块"""
+    return {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
+
+
+@lru_cache(maxsize=None)
+def batch_prompt_block(count):
+    """批量审核的提示词文本块（按图片数缓存）"""
+    return {"type": "text", "text": REVIEW_SYSTEM_PROMPT + REVIEW_BATCH_INSTRUCTION.format(count=count)}
+
+
+def review_batch(image_paths):
+    """在一次请求中审核多张图片，返回与image_paths一一对应的决策列表
+
+    请求失败或决策行数与图片数不一致时返回None，由调用方逐张审核。
+    """
+    content = [batch_prompt_block(len(image_paths))]
+    for image_path in image_paths:
+        image_data = encode_image_to_base64(image_path, max_size=896)
+        if not image_data:
+            return None
+        content.append(image_block(image_data))
+    
+    payload = {
+        **REVIEW_REQUEST_BASE,
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": 20 * len(image_paths) + 80,
+    }
+    
+    try:
+        status, result = post_json(f"{LM_STUDIO_BASE_URL}/chat/completions", payload,
+                                   timeout=60 * len(image_paths))
+        if status != 200:
+            return None
+        decisions = parse_decisions(result['choices'][0]['message']['content'])
+    except Exception:
+        return None
+    
+    if len(decisions) != len(image_paths):
+        return None
+    return decisions
+
+
 def review_with_lmstudio(image_path, max_retries=None):
     """使用LMstudio进行图片审核（非流式），支持无限重试"""
     retry_count = 0
@@ -104,53 +349,21 @@ def review_with_lmstudio(image_path, max_retries=None):
                 retry_count += 1
                 continue
             
-            # 构建请求
+            # 构建请求（只有图片内容块是新建的）
             payload = {
-                "model": LM_STUDIO_MODEL,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": REVIEW_SYSTEM_PROMPT
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_data}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                "max_tokens": 100,
-                "temperature": 0.1,
-                "stream": False
+                **REVIEW_REQUEST_BASE,
+                "messages": [{"role": "user", "content": [REVIEW_PROMPT_BLOCK, image_block(image_data)]}],
             }
             
             # 发送请求
-            response = requests.post(
-                f"{LM_STUDIO_BASE_URL}/chat/completions",
-                json=payload,
-                timeout=60
-            )
+            status, result = post_json(f"{LM_STUDIO_BASE_URL}/chat/completions", payload, timeout=60)
             
-            if response.status_code == 200:
-                result = response.json()
+            if status == 200:
                 content = result['choices'][0]['message']['content']
                 
-                # 解析响应
-                decision = None
-                
-                for line in content.split('\n'):
-                    line = line.strip()
-                    if line.startswith('Decision:'):
-                        decision_text = line.replace('Decision:', '').strip().upper()
-                        if 'PASS' in decision_text:
-                            decision = 'PASS'
-                        elif 'FAIL' in decision_text:
-                            decision = 'FAIL'
+                # 解析响应（有多行时以最后一个决策为准）
+                decisions = parse_decisions(content)
+                decision = decisions[-1] if decisions else None
                 
                 # 如果成功解析到决策，返回结果
                 if decision:
@@ -170,19 +383,39 @@ def review_with_lmstudio(image_path, max_retries=None):
             continue
 
 
-def get_artworks_by_filter(conn, classification=None, category=None, limit=None):
-    """根据条件筛选图片"""
-    query = "SELECT id, file_name, artist, title, classification, category FROM artworks WHERE 1=1"
+def get_pillow_backend():
+    """返回当前使用的Pillow版本说明（Pillow-SIMD的版本号带 .postN 后缀）"""
+    name = "Pillow-SIMD" if '.post' in PIL.__version__ else "Pillow"
+    return f"{name} {PIL.__version__}"
+
+
+def build_filter_clause(classification=None, category=None):
+    """构建筛选条件的WHERE子句，返回 (sql, params)"""
+    clause = " WHERE 1=1"
     params = []
     
     if classification:
-        query += " AND classification = ?"
+        clause += " AND classification = ?"
         params.append(classification)
     
     if category:
-        query += " AND category = ?"
+        clause += " AND category = ?"
         params.append(category)
     
+    return clause, params
+
+
+def count_artworks_by_filter(conn, classification=None, category=None, limit=None):
+    """统计符合条件的图片数量（不超过limit）"""
+    clause, params = build_filter_clause(classification, category)
+    total = conn.execute("SELECT COUNT(*) FROM artworks" + clause, params).fetchone()[0]
+    return min(total, limit) if limit else total
+
+
+def get_artworks_by_filter(conn, classification=None, category=None, limit=None):
+    """根据条件筛选图片，按FETCH_BATCH_SIZE行分批从游标读取并逐行返回，不一次性载入全部结果"""
+    clause, params = build_filter_clause(classification, category)
+    query = "SELECT id, file_name, artist, title, classification, category, phash FROM artworks" + clause
     query += " ORDER BY id"
     
     if limit:
@@ -190,27 +423,36 @@ def get_artworks_by_filter(conn, classification=None, category=None, limit=None)
         params.append(limit)
     
     cursor = conn.execute(query, params)
-    return cursor.fetchall()
+    while True:
+        rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+        if not rows:
+            return
+        yield from rows
 
 
-def review_artworks(classification=None, category=None, limit=None, start=1, output_file=None, workers=1):
-    """审核图片"""
-    # 连接数据库
-    conn = sqlite3.connect(config.DB_FILE)
+def review_artworks(classification=None, category=None, limit=None, start=1, output_file=None, workers=1, batch_size=1,
+                    use_cache=True):
+    """审核图片（use_cache为True时复用/记录按pHash缓存的审核结果）"""
+    # 连接数据库（WAL、mmap读取、较大的页缓存）
+    conn = open_db(config.DB_FILE)
+    # 与筛选条件和排序一致的索引，按分类/类别筛选时不需要扫描全表再排序
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_artworks_class_cat
+        ON artworks(classification, category, id)
+    """)
     
-    # 获取待审核的图片
-    artworks = get_artworks_by_filter(conn, classification, category, limit)
-    conn.close()
+    # 统计待审核的图片（图片本身在审核过程中从游标分批读取，连接在审核结束后关闭）
+    total = count_artworks_by_filter(conn, classification, category, limit)
     
-    if not artworks:
+    if not total:
         print("没有找到符合条件的图片")
+        conn.close()
         return
     
-    total = len(artworks)
-    
     # 验证起始位置
     if start < 1 or start > total:
         print(f"错误: 起始位置 {start} 超出范围 (1-{total})")
+        conn.close()
         return
     
     print(f"\n找到 {total} 张图片待审核")
@@ -226,9 +468,14 @@ def review_artworks(classification=None, category=None, limit=None, start=1, out
     if start > 1:
         filter_info.append(f"start={start}")
     filter_info.append(f"workers={workers}")
+    if batch_size > 1:
+        filter_info.append(f"batch_size={batch_size}")
+    if not use_cache:
+        filter_info.append("no_cache")
     
     if filter_info:
         print(f"筛选条件: {', '.join(filter_info)}")
+    print(f"图片缩放: {get_pillow_backend()}，滤镜 {REVIEW_RESAMPLE_FILTER.name}")
     
     print("=" * 70)
     
@@ -243,54 +490,94 @@ def review_artworks(classification=None, category=None, limit=None, start=1, out
     passed = 0
     failed = 0
     errors = 0
+    cached = 0
     stats_lock = threading.Lock()
-    file_lock = threading.Lock()
     
-    # 从指定位置开始审核
-    artworks_to_review = artworks[start-1:]
+    # 从指定位置开始审核（跳过的行只读取不保留）
+    artworks_to_review = islice(get_artworks_by_filter(conn, classification, category, limit), start - 1, None)
+    
+    cache = open_review_cache() if use_cache else None
+    
+    # 一次读取缩略图目录，之后在内存中判断缩略图是否存在
+    try:
+        thumbnail_names = set(os.listdir(config.THUMBNAIL_DIR))
+    except FileNotFoundError:
+        thumbnail_names = set()
     
-    def process_artwork(artwork, pbar):
-        """处理单个图片的审核"""
-        nonlocal passed, failed, errors
+    def process_batch(batch, pbar):
+        """审核一批图片，返回不通过的图片ID列表"""
+        nonlocal passed, failed, errors, cached
         
         # 检查是否需要退出
         if shutdown_flag.is_set():
-            return None
+            return []
         
-        artwork_id, file_name, artist, title, orig_classification, orig_category = artwork
+        # 更新进度条描述（不立即重绘，由主线程的 pbar.update 按刷新间隔统一重绘）
+        pbar.set_description(f"审核 ID:{batch[0][0]:06d}", refresh=False)
         
-        # 更新进度条描述
-        pbar.set_description(f"审核 ID:{artwork_id:06d}")
+        reviewable = []
+        for artwork in batch:
+            artwork_id = artwork[0]
+            
+            # 构建缩略图路径（缩略图文件名格式为 ID.jpg）
+            thumbnail_filename = f"{artwork_id:06d}.jpg"
+            thumbnail_path = os.path.join(config.THUMBNAIL_DIR, thumbnail_filename)
+            
+            if thumbnail_filename not in thumbnail_names:
+                with stats_lock:
+                    errors += 1
+                    pbar.set_postfix({"通过": passed, "不通过": failed, "错误": errors}, refresh=False)
+                continue
+            reviewable.append((artwork_id, thumbnail_path))
         
-        # 构建缩略图路径（缩略图文件名格式为 ID.jpg）
-        thumbnail_filename = f"{artwork_id:06d}.jpg"
-        thumbnail_path = os.path.join(config.THUMBNAIL_DIR, thumbnail_filename)
+        # 先查缓存（优先使用数据库中已有的pHash，没有时从缩略图计算）
+        cached_results = []
+        if cache is not None:
+            phashes = {artwork[0]: artwork[6] for artwork in batch}
+            uncached = []
+            for artwork_id, thumbnail_path in reviewable:
+                phash = phashes[artwork_id] or utils.calculate_phash(thumbnail_path)
+                decision = get_cached_decision(cache, phash) if phash else None
+                if decision:
+                    cached_results.append((artwork_id, decision))
+                else:
+                    uncached.append((artwork_id, thumbnail_path, phash))
+            reviewable = [(artwork_id, path) for artwork_id, path, _ in uncached]
         
-        if not os.path.exists(thumbnail_path):
-            with stats_lock:
-                errors += 1
-                pbar.set_postfix({"通过": passed, "不通过": failed, "错误": errors})
-            return None
+        # 多张图片先尝试一次请求批量审核
+        decisions = None
+        if len(reviewable) > 1:
+            decisions = review_batch([path for _, path in reviewable])
         
-        # 调用LLM审核（会自动重试直到成功或用户中断）
-        decision = review_with_lmstudio(thumbnail_path)
+        # 批量审核失败时逐张审核（会自动重试直到成功或用户中断）
+        if decisions is None:
+            decisions = []
+            for _, thumbnail_path in reviewable:
+                decision = review_with_lmstudio(thumbnail_path)
+                # 如果返回None，说明用户中断了
+                if decision is None:
+                    break
+                decisions.append(decision)
         
-        # 如果返回None，说明用户中断了
-        if decision is None:
-            return None
+        if cache is not None:
+            store_decisions(cache, [(phash, decision)
+                                    for (_, _, phash), decision in zip(uncached, decisions) if phash])
         
-        result = None
+        failed_ids = []
         with stats_lock:
-            if decision == 'PASS':
-                passed += 1
-            elif decision == 'FAIL':
-                failed += 1
-                result = artwork_id
+            cached += len(cached_results)
+            results = [(artwork_id, decision) for (artwork_id, _), decision in zip(reviewable, decisions)]
+            for artwork_id, decision in results + cached_results:
+                if decision == 'PASS':
+                    passed += 1
+                elif decision == 'FAIL':
+                    failed += 1
+                    failed_ids.append(artwork_id)
             
             # 更新进度条统计
-            pbar.set_postfix({"通过": passed, "不通过": failed, "错误": errors})
+            pbar.set_postfix({"通过": passed, "不通过": failed, "错误": errors}, refresh=False)
         
-        return result
+        return failed_ids
     
     # 设置信号处理
     def signal_handler(signum, frame):
@@ -301,45 +588,79 @@ def review_artworks(classification=None, category=None, limit=None, start=1, out
     # 开始审核（追加模式，不清空已有内容）
     try:
         with open(output_path, 'a', encoding='utf-8') as f:
+            # 结果只在主线程中写入文件，无需加锁
+            pending_failed_ids = []
+            last_flush = time.monotonic()
+            
+            def flush_failed_ids():
+                """把缓存的不通过ID写入文件（只写ID）并落盘"""
+                nonlocal last_flush
+                if pending_failed_ids:
+                    f.write(''.join(f"{artwork_id:06d}\n" for artwork_id in pending_failed_ids))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    pending_failed_ids.clear()
+                last_flush = time.monotonic()
+            
             # 使用tqdm进度条
-            with tqdm(total=total,
-                     initial=start-1,
-                     desc="审核进度",
-                     unit="张") as pbar:
-                
-                # 使用线程池
-                with ThreadPoolExecutor(max_workers=workers) as executor:
-                    # 提交所有任务
-                    futures = {
-                        executor.submit(process_artwork, artwork, pbar): artwork 
-                        for artwork in artworks_to_review
-                    }
+            try:
+                with tqdm(total=total,
+                         initial=start-1,
+                         desc="审核进度",
+                         unit="张") as pbar:
                     
-                    # 处理完成的任务
-                    for future in as_completed(futures):
-                        if shutdown_flag.is_set():
-                            # 取消所有未完成的任务
-                            for f in futures:
-                                f.cancel()
-                            break
-                        
-                        try:
-                            result = future.result()
-                            if result is not None:
-                                # 写入文件（只写ID）
-                                with file_lock:
-                                    f.write(f"{result:06d}\n")
-                                    f.flush()  # 实时写入
-                        except Exception as e:
-                            with stats_lock:
-                                errors += 1
+                    # 按batch_size分批，每批作为一个任务提交到线程池；批次在提交时才从游标读取，不预先生成全部列表
+                    batch_iter = iter(lambda: list(islice(artworks_to_review, batch_size)), [])
+                    
+                    # 使用线程池，在途任务数限制为线程数的两倍：不一次性为所有图片创建任务，
+                    # 中断时也只需取消少量尚未开始的任务
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        futures = {
+                            executor.submit(process_batch, batch, pbar): batch
+                            for batch in islice(batch_iter, workers * 2)
+                        }
                         
-                        pbar.update(1)
+                        # 处理完成的任务，每完成一个再提交下一个
+                        while futures:
+                            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                            if shutdown_flag.is_set():
+                                # 取消所有未完成的任务
+                                for future in futures:
+                                    future.cancel()
+                                break
+                            
+                            for future in done:
+                                batch = futures.pop(future)
+                                try:
+                                    pending_failed_ids.extend(future.result())
+                                except Exception as e:
+                                    with stats_lock:
+                                        errors += len(batch)
+                                
+                                pbar.update(len(batch))
+                                
+                                if (len(pending_failed_ids) >= FAILED_IDS_FLUSH_COUNT
+                                        or time.monotonic() - last_flush >= FAILED_IDS_FLUSH_INTERVAL):
+                                    flush_failed_ids()
+                                
+                                next_batch = next(batch_iter, None)
+                                if next_batch is not None:
+                                    futures[executor.submit(process_batch, next_batch, pbar)] = next_batch
+
+            finally:
+                # 正常结束、中断或出错时都写入剩余的ID
+                flush_failed_ids()
     
     except KeyboardInterrupt:
         print("\n\n用户中断，正在退出...")
         shutdown_flag.set()
     
+    conn.close()
+    
+    if cache is not None:
+        evict_review_cache(cache)
+        cache.close()
+    
     # 输出统计
     print("\n" + "=" * 70)
     if shutdown_flag.is_set():
@@ -349,91 +670,56 @@ def review_artworks(classification=None, category=None, limit=None, start=1, out
     print(f"  ✓ 通过: {passed}")
     print(f"  ✗ 不通过: {failed}")
     print(f"  ⚠ 错误: {errors}")
+    print(f"  ↺ 使用缓存结果: {cached}")
     print(f"\n不通过的图片ID已写入: {output_path}")
     print("=" * 70 + "\n")
 
 
+def positive_int(value):
+    """argparse类型：大于0的整数"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"必须大于0: {value}")
+    return number
+
+
 def main():
     """主函数"""
-    # 默认参数
-    classification = None
-    category = None
-    limit = None
-    start = 1
-    output_file = None
-    workers = 4
-    
-    # 解析命令行参数
-    args = sys.argv[1:]
-    i = 0
-    while i < len(args):
-        arg = args[i]
-        
-        if arg == '--classification' and i + 1 < len(args):
-            classification = args[i + 1]
-            i += 2
-        elif arg == '--category' and i + 1 < len(args):
-            category = args[i + 1]
-            i += 2
-        elif arg == '--limit' and i + 1 < len(args):
-            try:
-                limit = int(args[i + 1])
-            except ValueError:
-                print(f"错误: --limit 参数必须是整数")
-                sys.exit(1)
-            i += 2
-        elif arg == '--start' and i + 1 < len(args):
-            try:
-                start = int(args[i + 1])
-            except ValueError:
-                print(f"错误: --start 参数必须是整数")
-                sys.exit(1)
-            i += 2
-        elif arg == '--workers' and i + 1 < len(args):
-            try:
-                workers = int(args[i + 1])
-                if workers < 1:
-                    print(f"错误: --workers 参数必须大于0")
-                    sys.exit(1)
-            except ValueError:
-                print(f"错误: --workers 参数必须是整数")
-                sys.exit(1)
-            i += 2
-        elif arg == '--output' and i + 1 < len(args):
-            output_file = args[i + 1]
-            i += 2
-        elif arg in ['--help', '-h']:
-            print("用法: python llm_image_review.py [选项]")
-            print("\n选项:")
-            print("  --classification <value>  筛选指定分类 (sfw/mature/nsfw)")
-            print("  --category <value>        筛选指定类别 (fanart_non_comic/fanart_comic/real_photo/other)")
-            print("  --limit <n>               限制审核数量")
-            print("  --start <n>               从第n个筛选结果开始 (默认: 1)")
-            print("  --workers <n>             并发线程数 (默认: 4)")
-            print("  --output <file>           指定输出文件名 (默认: review_failed_<timestamp>.txt)")
-            print("  --help, -h                显示帮助信息")
-            print("\n示例:")
-            print("  python llm_image_review.py --classification sfw")
-            print("  python llm_image_review.py --classification sfw --limit 100")
-            print("  python llm_image_review.py --classification sfw --start 50")
-            print("  python llm_image_review.py --classification sfw --workers 8")
-            print("  python llm_image_review.py --category fanart_non_comic --classification sfw")
-            print("  python llm_image_review.py --output my_review.txt")
-            print("\n提示:")
-            print("  - 按 Ctrl+C 可以优雅退出，已处理的结果会保存")
-            print("  - 多线程可以加快处理速度，但注意LLM服务器的负载")
-            print("\nLLM配置:")
-            print(f"  LMstudio地址: {LM_STUDIO_BASE_URL}")
-            print(f"  模型名称: {LM_STUDIO_MODEL}")
-            return
-        else:
-            print(f"错误: 未知参数 '{arg}'")
-            print("使用 --help 查看帮助信息")
-            sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description="LLM图片审核工具：审核数据库中的图片，将不通过的图片ID写入文件",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=f"""示例:
+  python llm_image_review.py --classification sfw
+  python llm_image_review.py --classification sfw --limit 100
+  python llm_image_review.py --classification sfw --start 50
+  python llm_image_review.py --classification sfw --workers 8
+  python llm_image_review.py --classification sfw --batch-size 4
+  python llm_image_review.py --category fanart_non_comic --classification sfw
+  python llm_image_review.py --output my_review.txt
+
+提示:
+  - 按 Ctrl+C 可以优雅退出，已处理的结果会保存
+  - 多线程可以加快处理速度，但注意LLM服务器的负载
+
+LLM配置:
+  LMstudio地址: {LM_STUDIO_BASE_URL}
+  模型名称: {LM_STUDIO_MODEL}
+  缩放滤镜: {REVIEW_RESAMPLE_FILTER.name} (config.REVIEW_RESAMPLE_FILTER, {get_pillow_backend()})""")
+    parser.add_argument("--classification", help="筛选指定分类 (sfw/mature/nsfw)")
+    parser.add_argument("--category", help="筛选指定类别 (fanart_non_comic/fanart_comic/real_photo/other)")
+    parser.add_argument("--limit", type=int, help="限制审核数量")
+    parser.add_argument("--start", type=int, default=1, help="从第n个筛选结果开始 (默认: 1)")
+    parser.add_argument("--workers", type=positive_int, default=4, help="并发线程数 (默认: 4)")
+    parser.add_argument("--batch-size", type=positive_int, default=1,
+                        help="每次请求审核的图片数，失败时自动逐张审核 (默认: 1)")
+    parser.add_argument("--output", help="指定输出文件名 (默认: review_failed_<timestamp>.txt)")
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=True,
+                        help="使用按pHash缓存的审核结果，--no-cache 全部重新审核 (默认: 使用)")
+    args = parser.parse_args()
     
     # 开始审核
-    review_artworks(classification, category, limit, start, output_file, workers)
-
+    review_artworks(args.classification, args.category, args.limit, args.start, args.output,
+                    args.workers, args.batch_size, args.cache)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,38 @@
+"""
+管理脚本共用的图片处理进程池
+
+需要在导入 numpy/imagehash 之前导入本模块，线程数设置才会生效。
+"""
+
+import os
+
+# 并行由进程池负责，每个进程内的数值库只用单线程，避免线程数成倍超过CPU核数
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+# 图库中的大图都是可信的本地文件，关闭PIL的解压炸弹保护
+Image.MAX_IMAGE_PIXELS = None
+
+WORKER_COUNT = os.cpu_count()
+
+
+def init_image_worker(initializer=None, initargs=()):
+    """工作进程初始化：提前注册常用图片格式插件并导入imagehash，不在第一个任务里加载
+
+    initializer 为脚本自己的初始化函数（需定义在模块顶层），在每个工作进程中执行一次。
+    """
+    Image.preinit()
+    try:
+        import imagehash  # noqa: F401
+    except ImportError:
+        pass
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def create_image_pool(max_workers=WORKER_COUNT, initializer=None, initargs=()):
+    """创建图片处理用的进程池，initializer/initargs 与 ProcessPoolExecutor 的同名参数相同"""
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=init_image_worker,
+                               initargs=(initializer, initargs))
@@ -5,6 +5,10 @@ Twitter元数据解析器
 
 import re
 
+# 批量导入时每条元数据都会用到，预编译避免每次调用查找正则缓存
+HASHTAG_RE = re.compile(r'#\w+\s*')
+TITLE_INDEX_SUFFIX_RE = re.compile(r'\s*\(\d+\)\s*$')
+
 
 def parse_twitter_metadata(data, image_position=None, total_images=None, is_multi_image_post=None):
     """
@@ -39,7 +43,7 @@ def parse_twitter_metadata(data, image_position=None, total_images=None, is_mult
     title = data.get('title')
     if not title and description:
         # 从描述提取标题（去除hashtag）
-        clean_desc = re.sub(r'#\w+\s*', '', description).strip()
+        clean_desc = HASHTAG_RE.sub('', description).strip()
         if clean_desc:  # 确保不是空字符串
             title = clean_desc.split('\n')[0][:200]
     
@@ -51,7 +55,7 @@ def parse_twitter_metadata(data, image_position=None, total_images=None, is_mult
     if title:
         is_multi = (is_multi_image_post is True) or (total_images and total_images > 1)
         if is_multi and image_position:
-            if not re.search(r'\s*\(\d+\)\s*$', title):
+            if not TITLE_INDEX_SUFFIX_RE.search(title):
                 title = f"{title} ({image_position})"
     
     # 提取标签
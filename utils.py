@@ -16,20 +16,27 @@ IMAGES_PER_PAGE = config.IMAGES_PER_PAGE
 os.makedirs(THUMBNAIL_DIR, exist_ok=True)
 
 # --- 共享的辅助函数 ---
-def get_publication_date(full_path):
+# EXIF主IFD中指向Exif子IFD的标签
+EXIF_IFD_POINTER = 0x8769
+# 文件名开头的日期：YYYY[-_]MM[-_]DD 或 YYYYMMDD
+FILENAME_DATE_RE = re.compile(r'^(?P<year>\d{4})[-_]?(?P<month>\d{2})[-_]?(?P<day>\d{2})')
+
+def get_publication_date(full_path, ctime=None):
     """
     通过优先级策略获取发布日期。
     返回 (datetime对象, 来源字符串)
     优先级：EXIF -> 文件名解析 (YYYY[-_]MM[-_]DD 等) -> 文件系统 ctime
+    ctime 可由调用方传入已取得的创建时间，省去一次 os.path.getctime。
     """
-    # 策略 1: EXIF
+    # 策略 1: EXIF（Image.open 只解析文件头；getexif() 按需解析IFD，不展开GPS、MakerNote等无关数据）
     try:
         with Image.open(full_path) as img:
-            exif_data = getattr(img, "_getexif", lambda: None)()
+            exif_data = img.getexif()
             if exif_data:
-                for tag_id in [36867, 306]:
-                    if tag_id in exif_data:
-                        date_str = exif_data[tag_id]
+                # DateTimeOriginal(36867) 在 Exif 子IFD(0x8769)中，DateTime(306) 在主IFD中
+                candidates = [exif_data.get_ifd(EXIF_IFD_POINTER).get(36867), exif_data.get(306)]
+                for date_str in candidates:
+                    if date_str:
                         try:
                             return datetime.datetime.strptime(date_str, '%Y:%m:%d %H:%M:%S'), "EXIF"
                         except Exception:
@@ -39,7 +46,7 @@ def get_publication_date(full_path):
 
     # 策略 2: 从文件名解析 YYYY[-_]MM[-_]DD 或 YYYYMMDD
     filename = os.path.basename(full_path)
-    match = re.match(r'^(?P<year>\d{4})[-_]? (?P<month>\d{2})[-_]? (?P<day>\d{2})'.replace(" ",""), filename)
+    match = FILENAME_DATE_RE.match(filename)
     if match:
         try:
             parts = match.groupdict()
@@ -49,16 +56,93 @@ def get_publication_date(full_path):
 
     # 策略 3: 使用文件创建时间 (ctime)
     try:
-        ctime = os.path.getctime(full_path)
+        if ctime is None:
+            ctime = os.path.getctime(full_path)
         return datetime.datetime.fromtimestamp(ctime), "File System (ctime)"
     except Exception:
         # 最后兜底，返回当前时间
         return datetime.datetime.now(), "Fallback"
 
+def batch_publication_dates(dir_path):
+    """获取目录下所有文件的发布日期，返回 {文件名: (datetime对象, 来源字符串)}
+
+    只 scandir 一次目录，ctime 直接取自目录项的 stat 结果（Windows上无需额外系统调用），
+    每个文件的优先级与 get_publication_date 相同。
+    """
+    dates = {}
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            try:
+                ctime = entry.stat().st_ctime
+            except OSError:
+                ctime = None
+            dates[entry.name] = get_publication_date(entry.path, ctime=ctime)
+    return dates
+
 def normalize_path(path):
     """统一规范化文件路径处理"""
     return path.replace('\\', '/')
 
+def find_existing_files(paths):
+    """批量检查文件是否存在，返回其中存在的路径集合
+
+    按目录分组，每个目录只scandir一次，代替逐个os.path.exists（每次一个stat调用）。
+    文件名按os.path.normcase比较，Windows上与os.path.exists一样不区分大小写。
+    """
+    paths_by_dir = {}
+    for path in paths:
+        if path:
+            paths_by_dir.setdefault(os.path.dirname(path), []).append(path)
+
+    existing = set()
+    for dir_path, dir_paths in paths_by_dir.items():
+        try:
+            with os.scandir(dir_path or '.') as entries:
+                names = {os.path.normcase(entry.name) for entry in entries if entry.is_file()}
+        except FileNotFoundError:
+            continue  # 目录不存在，其中的文件自然都不存在
+        except OSError:
+            existing.update(path for path in dir_paths if os.path.isfile(path))
+            continue
+        existing.update(path for path in dir_paths if os.path.normcase(os.path.basename(path)) in names)
+    return existing
+
+# 快速完整性检查时读取的文件末尾字节数（部分JPEG在结束标记后还附带少量数据）
+IMAGE_TAIL_PROBE_SIZE = 1024
+
+def is_image_file_complete(path):
+    """只读文件头和末尾判断图片是否完整（不解码），用于快速发现截断或无效的文件
+
+    JPEG/PNG/GIF检查文件头和结束标记，WebP检查RIFF头记录的长度；
+    其他格式只解析文件头。需要逐字节校验时请使用 Image.verify()。
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(16)
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            f.seek(max(0, file_size - IMAGE_TAIL_PROBE_SIZE))
+            tail = f.read()
+    except OSError:
+        return False
+
+    if head.startswith(b'\xff\xd8'):
+        return b'\xff\xd9' in tail
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return b'IEND' in tail
+    if head.startswith(b'GIF8'):
+        return tail.rstrip(b'\x00').endswith(b';')
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return int.from_bytes(head[4:8], 'little') + 8 <= file_size
+
+    try:
+        with Image.open(path) as img:
+            return img.width > 0 and img.height > 0
+    except Exception:
+        return False
+
 def generate_timestamp_seed():
     """生成时间戳种子用于随机排序"""
     import time
@@ -68,10 +152,20 @@ def create_thumbnail(src_path, dest_path, size=THUMBNAIL_SIZE, quality=THUMBNAIL
     """创建缩略图的标准函数"""
     try:
         with Image.open(src_path) as img:
-            img.thumbnail(size)
-            if img.mode != 'RGB':
+            # JPEG解码时直接按1/2、1/4、1/8缩小到不小于缩略图尺寸，省去大部分像素的解码
+            if img.format == 'JPEG':
+                ratio = min(size[0] / img.width, size[1] / img.height)
+                if ratio < 1:
+                    img.draft('RGB', (max(1, int(img.width * ratio)), max(1, int(img.height * ratio))))
+            img.thumbnail(size, Image.Resampling.BICUBIC)
+            # 透明图铺白底；RGB和灰度图可直接保存为JPEG，不再转换
+            if img.mode == 'RGBA':
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[-1])
+                img = background
+            elif img.mode not in ('RGB', 'L'):
                 img = img.convert('RGB')
-            img.save(dest_path, "JPEG", quality=quality)
+            img.save(dest_path, "JPEG", quality=quality, optimize=False, progressive=False)
         return True
     except Exception as e:
         print(f"Failed to create thumbnail: {e}")
@@ -155,34 +249,78 @@ def build_artwork_query(filters, sort_key=None, offset=None, limit=None):
     if where_clauses:
         base_query += " WHERE " + " AND ".join(where_clauses)
 
-    # 添加排序
+    # 添加排序（从固定的几种ORDER BY中选择，同一组筛选条件总是生成相同的SQL文本，可复用已编译的语句）
     if sort_key:
-        sort_map = {
-            'rating': 'rating DESC, publication_date DESC',
-            'newest': 'publication_date DESC',
-            'oldest': 'publication_date ASC',
-            'latest_added': 'last_modified_date DESC'
-        }
-        order_by = sort_map.get(sort_key, 'publication_date DESC')
-        if 'random' in sort_key or sort_key == 'random':
-            order_by = get_random_sort_order(filters)
-        base_query += f" ORDER BY {order_by}"
+        if 'random' in sort_key:
+            base_query += SORT_ORDERS['random']
+        else:
+            base_query += SORT_ORDERS.get(sort_key, SORT_ORDERS['newest'])
 
     # 添加分页
     if limit and offset is not None:
-        base_query += f" LIMIT {limit} OFFSET {offset}"
+        base_query += " LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
 
     return base_query, params
 
-def get_random_sort_order(filters):
-    """基于种子的简单随机排序算法"""
-    seed = filters.get('seed', generate_timestamp_seed())
+# 随机排序键：id 乘奇数 -> 异或移位 -> 再乘奇数（均取低31位），对2^31以内的id是一一映射（不会重复）。
+# 键与种子无关，可以建表达式索引，按它排序只需顺序扫描索引。SQLite没有异或运算符，用 (a|b)-(a&b) 代替
+_SHUFFLE_MIX = "((id * 2654435761) & 2147483647)"
+_SHUFFLE_MIX = f"(({_SHUFFLE_MIX} | ({_SHUFFLE_MIX} >> 16)) - ({_SHUFFLE_MIX} & ({_SHUFFLE_MIX} >> 16)))"
+SHUFFLE_KEY_EXPR = f"(({_SHUFFLE_MIX} * 2246822519) & 2147483647)"
+
+# build_artwork_query 可用的排序方式
+SORT_ORDERS = {
+    'rating': " ORDER BY rating DESC, publication_date DESC",
+    'newest': " ORDER BY publication_date DESC",
+    'oldest': " ORDER BY publication_date ASC",
+    'latest_added': " ORDER BY last_modified_date DESC",
+    'random': f" ORDER BY {SHUFFLE_KEY_EXPR}",
+}
+
+def ensure_shuffle_index(conn):
+    """创建随机排序键的表达式索引（需要可写连接）"""
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_artworks_shuffle ON artworks({SHUFFLE_KEY_EXPR})")
+    conn.commit()
+
+def get_random_rotation(filters, sort_key, total):
+    """随机排序时，按种子计算结果序列旋转的位置；非随机排序、无结果或种子无效时返回0"""
+    if not sort_key or 'random' not in sort_key or total <= 0:
+        return 0
     try:
-        seed = int(seed)
-        # 原始简单的随机算法公式
-        return f"((id * {seed}) % 1000000)"
-    except ValueError:
-        return 'publication_date DESC'
+        return int(filters.get('seed', 0)) % total
+    except (TypeError, ValueError):
+        return 0
+
+def rotate_for_seed(rows, filters, sort_key):
+    """把按 build_artwork_query 排序取出的完整结果按种子旋转"""
+    shift = get_random_rotation(filters, sort_key, len(rows))
+    return rows[shift:] + rows[:shift] if shift else rows
+
+def fetch_artwork_page(db, base_query, params, filters, sort_key, total, offset, limit):
+    """分页取出 SELECT * 结果，total 为该查询的总条数
+
+    随机排序时在旋转后的序列上分页：从种子对应的位置开始按索引顺序读取，
+    读到末尾再从头补齐，不需要对全部记录排序。
+    """
+    main_query = "SELECT * " + base_query
+    if not limit:
+        return rotate_for_seed(db.execute(main_query, params).fetchall(), filters, sort_key)
+
+    # LIMIT/OFFSET 作为参数传入，翻页时SQL文本不变
+    page_query = main_query + " LIMIT ? OFFSET ?"
+    shift = get_random_rotation(filters, sort_key, total)
+    if not shift:
+        return db.execute(page_query, [*params, limit, offset]).fetchall()
+
+    wanted = min(limit, total - offset)
+    if wanted <= 0:
+        return []
+    start = (shift + offset) % total
+    rows = db.execute(page_query, [*params, wanted, start]).fetchall()
+    if len(rows) < wanted:
+        rows += db.execute(page_query, [*params, wanted - len(rows), 0]).fetchall()
+    return rows
 
 def get_aspect_ratios(ar_db, artwork_ids):
     """